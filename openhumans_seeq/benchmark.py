@@ -0,0 +1,283 @@
+"""
+Local stand-ins for Open Humans, Seeq and S3, for offline benchmarks.
+
+FakeServices serves the Open Humans OAuth token, exchange-member and
+upload/direct/complete APIs, plus S3-style GET (with Range) and PUT, from
+one local HTTP server. FakeSeeqClient answers Seeq participant and raw data
+calls in-process, listing files hosted by that server. Latency is added to
+every request and transfer bandwidth is capped per connection.
+
+Used by the benchmark_transfers management command.
+"""
+from __future__ import print_function
+
+import hashlib
+import itertools
+import json
+import os
+import re
+import resource
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import urllib.parse as urlparse
+
+BLOCK_SIZE = 64 * 1024
+PATTERN = b'ACGT'
+
+
+def fake_content(start, end):
+    """
+    Return bytes start to end (exclusive) of a fake file's content.
+    """
+    offset = start % len(PATTERN)
+    repeats = (end - start + offset) // len(PATTERN) + 1
+    return (PATTERN * repeats)[offset:offset + end - start]
+
+
+def fake_md5(size):
+    file_md5 = hashlib.md5()
+    for start in range(0, size, BLOCK_SIZE):
+        file_md5.update(fake_content(start, min(start + BLOCK_SIZE, size)))
+    return file_md5.hexdigest()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServicesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def services(self):
+        return self.server.services
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        """
+        Read the request body at the capped bandwidth, returning its size.
+        """
+        remaining = int(self.headers.get('Content-Length', 0))
+        size = 0
+        while remaining:
+            start = time.time()
+            chunk = self.rfile.read(min(BLOCK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            size += len(chunk)
+            self.services.throttle(len(chunk), start)
+        return size
+
+    def _query(self):
+        return urlparse.parse_qs(urlparse.urlsplit(self.path)[3])
+
+    def do_GET(self):
+        time.sleep(self.services.latency)
+        path = urlparse.urlsplit(self.path)[2]
+        if path == '/api/direct-sharing/project/exchange-member/':
+            token = self._query().get('access_token', [''])[0]
+            oh_id = token.replace('bench-token-', '', 1)
+            self._send_json(200, {
+                'project_member_id': oh_id,
+                'data': self.services.uploaded_files(oh_id)})
+        elif path.startswith('/seeq-s3/'):
+            self._send_file(path.split('/')[-1])
+        else:
+            self._send_json(404, {'detail': 'Not found.'})
+
+    def _send_file(self, filename):
+        size = self.services.file_size
+        start, end = 0, size
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', '"{}"'.format(self.services.file_md5))
+        self.end_headers()
+        for block_start in range(start, end, BLOCK_SIZE):
+            sent = time.time()
+            block = fake_content(block_start,
+                                 min(block_start + BLOCK_SIZE, end))
+            self.wfile.write(block)
+            self.services.throttle(len(block), sent)
+
+    def do_PUT(self):
+        time.sleep(self.services.latency)
+        size = self._read_body()
+        self.services.record_put(size)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        time.sleep(self.services.latency)
+        path = urlparse.urlsplit(self.path)[2]
+        length = int(self.headers.get('Content-Length', 0))
+        form = urlparse.parse_qs(self.rfile.read(length).decode('utf-8'))
+        if path == '/oauth2/token/':
+            oh_id = form.get('refresh_token', [''])[0].replace(
+                'bench-refresh-', '', 1)
+            self._send_json(200, {
+                'access_token': 'bench-token-{}'.format(oh_id),
+                'refresh_token': 'bench-refresh-{}'.format(oh_id),
+                'expires_in': 36000})
+        elif path == '/api/direct-sharing/project/files/upload/direct/':
+            file_id = self.services.start_upload(
+                form['project_member_id'][0], form['filename'][0])
+            self._send_json(201, {
+                'id': file_id,
+                'url': '{}oh-s3/{}'.format(self.services.base_url, file_id)})
+        elif path == '/api/direct-sharing/project/files/upload/complete/':
+            self.services.complete_upload(int(form['file_id'][0]))
+            self._send_json(200, {})
+        else:
+            self._send_json(404, {'detail': 'Not found.'})
+
+
+class FakeServices(object):
+    """
+    Run the fake Open Humans and S3 endpoints on a local port.
+
+    latency is seconds added to each request, bandwidth is bytes/second per
+    connection (0 for no cap) and file_size is the size of every Seeq file.
+    """
+    def __init__(self, port, latency=0.0, bandwidth=0, file_size=1000000):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.file_size = file_size
+        self.file_md5 = fake_md5(file_size)
+        self.base_url = 'http://127.0.0.1:{}/'.format(port)
+        self.bytes_put = 0
+        self._uploads = {}
+        self._file_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port),
+                                           FakeServicesHandler)
+        self._server.services = self
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def throttle(self, size, start):
+        if self.bandwidth:
+            delay = float(size) / self.bandwidth - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    def start_upload(self, oh_id, filename):
+        with self._lock:
+            file_id = next(self._file_ids)
+            self._uploads[file_id] = {'oh_id': oh_id, 'basename': filename,
+                                      'complete': False}
+        return file_id
+
+    def complete_upload(self, file_id):
+        with self._lock:
+            self._uploads[file_id]['complete'] = True
+
+    def record_put(self, size):
+        with self._lock:
+            self.bytes_put += size
+
+    def uploaded_files(self, oh_id):
+        with self._lock:
+            return [{'id': file_id, 'basename': upload['basename']}
+                    for file_id, upload in self._uploads.items()
+                    if upload['oh_id'] == oh_id and upload['complete']]
+
+
+class FakeSeeqClient(object):
+    """
+    Stand-in for SeeqClient, listing files served by FakeServices.
+
+    members maps Seeq participant IDs to Open Humans member IDs.
+    """
+    def __init__(self, services, members, files_per_member):
+        self.services = services
+        self.members = members
+        self.files_per_member = files_per_member
+
+    def study_participants_get(self, study_id):
+        time.sleep(self.services.latency)
+        return [{'id': seeq_id, 'external_id': oh_id}
+                for seeq_id, oh_id in self.members.items()]
+
+    def study_raw_data_get(self, study_id, participant_ids):
+        time.sleep(self.services.latency)
+        return [{'participant_id': seeq_id,
+                 'url_s3': '{}seeq-s3/{}/sample-{}.bam'.format(
+                     self.services.base_url, seeq_id, n)}
+                for seeq_id in participant_ids
+                for n in range(self.files_per_member)]
+
+
+class DiskMonitor(object):
+    """
+    Track the most disk space used under a directory, sampled on a thread.
+    """
+    def __init__(self, path, interval=0.05):
+        self.path = path
+        self.interval = interval
+        self.high_water = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _usage(self):
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.high_water = max(self.high_water, self._usage())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def peak_rss():
+    """
+    Return this process's peak resident set size in bytes (Linux units).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
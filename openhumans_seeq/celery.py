@@ -6,14 +6,36 @@ http://celery.readthedocs.org/en/latest/django/first-steps-with-django.html
 # and the celery package.
 from __future__ import absolute_import
 
+from datetime import timedelta
 import os
 
 from celery import Celery
+from kombu import Queue
 
 from django.conf import settings
 
 CELERY_BROKER_URL = os.getenv('CLOUDAMQP_URL', 'amqp://')
 
+# The 'auth' queue has short tasks a new member's page waits on, so they're
+# never stuck behind a transfer. Tasks on the 'interactive' queue get new
+# members their first files. The 'bulk' queue holds resync work, so a large
+# sync never delays a signup. Each queue has its own workers in the Procfile.
+TASK_QUEUES = {
+    'openhumans_seeq.tasks.complete_oh_authorization': 'auth',
+    'openhumans_seeq.tasks.sweep_pending_members': 'auth',
+    'openhumans_seeq.tasks.init_xfer_to_open_humans': 'interactive',
+    'openhumans_seeq.tasks.refresh_expiring_tokens': 'bulk',
+    'openhumans_seeq.tasks.transfer_member': 'bulk',
+    'openhumans_seeq.tasks.xfer_to_open_humans': 'bulk',
+}
+# Celery rate limits (e.g. '30/m') for each task on a queue, per worker
+# process. None for no limit.
+QUEUE_RATE_LIMITS = {
+    'auth': None,
+    'interactive': os.getenv('INTERACTIVE_RATE_LIMIT') or None,
+    'bulk': os.getenv('BULK_RATE_LIMIT') or None,
+}
+
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE',
                       'openhumans_seeq.settings')
@@ -26,9 +48,33 @@ app.conf.update({
     'BROKER_POOL_LIMIT': 1,
     'BROKER_HEARTBEAT': None,
     'BROKER_CONNECTION_TIMEOUT': 30,
-    'CELERY_RESULT_BACKEND': None,
+    # Only needed to collect results, e.g. for 'sync_all --distributed'.
+    'CELERY_RESULT_BACKEND': os.getenv('CELERY_RESULT_BACKEND'),
+    'CELERY_QUEUES': (Queue('auth'), Queue('interactive'), Queue('bulk')),
+    'CELERY_DEFAULT_QUEUE': 'bulk',
+    'CELERY_ROUTES': {name: {'queue': queue}
+                      for name, queue in TASK_QUEUES.items()},
+    'CELERY_ANNOTATIONS': {name: {'rate_limit': QUEUE_RATE_LIMITS[queue]}
+                           for name, queue in TASK_QUEUES.items()
+                           if QUEUE_RATE_LIMITS[queue]},
+    # Workers reserve one task per process at a time, so a long transfer
+    # doesn't hold back tasks another process could start. Each Procfile
+    # worker sets its own multiplier.
+    'CELERYD_PREFETCH_MULTIPLIER': 1,
     'CELERY_SEND_EVENTS': False,
     'CELERY_EVENT_QUEUE_EXPIRES': 60,
+    'CELERYBEAT_SCHEDULE': {
+        'refresh-expiring-tokens': {
+            'task': 'openhumans_seeq.tasks.refresh_expiring_tokens',
+            'schedule': timedelta(minutes=15),
+        },
+        'sweep-pending-members': {
+            'task': 'openhumans_seeq.tasks.sweep_pending_members',
+            'schedule': timedelta(seconds=30),
+            # Drop sweeps that wait longer than a sweep interval.
+            'options': {'expires': 30},
+        },
+    },
 })
 
 
@@ -1,124 +1,757 @@
 from __future__ import print_function
 
+from collections import OrderedDict
 import hashlib
 import json
+from multiprocessing.pool import ThreadPool
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 try:
     import urlparse
 except ImportError:
     import urllib.parse as urlparse
 
+from django.db import connection
 import requests
-import seeq
+from requests.utils import super_len
 
-from .utils import oh_get_member_data
+from . import httpclient, metrics, ratelimit
+from .models import SeeqFileTransfer
+from .utils import (OH_BASE_URL, get_seeq_client, invalidate_member_data,
+                    oh_get_member_data)
 
-OH_API_BASE = 'https://www.openhumans.org/api/direct-sharing'
+OH_API_BASE = '{}api/direct-sharing'.format(OH_BASE_URL)
 MAX_FILESIZE = 1000000000  # Max of 1GB file to Open Humans.
-SEEQ_REFRESH_TOKEN = os.getenv('SEEQ_REFRESH_TOKEN')
+CHUNK_SIZE = 1024 * 1024  # Read/write buffer for file transfers.
 SEEQ_STUDY_ID = int(os.getenv('SEEQ_STUDY_ID'))
 
+# 'disk' downloads each Seeq file to the tempdir before uploading it.
+# 'stream' pipes it straight from Seeq S3 to Open Humans S3 when the MD5 is
+# known up front, and falls back to 'disk' otherwise.
+SEEQ_TRANSFER_MODE = os.getenv('SEEQ_TRANSFER_MODE', 'disk').lower()
 
-def get_md5(filepath):
+# Number of Seeq participants to list per raw data call.
+SEEQ_LISTING_CHUNK = int(os.getenv('SEEQ_LISTING_CHUNK', '50'))
+
+# Number of a member's files to copy at once.
+DATAXFER_MAX_WORKERS = int(os.getenv('DATAXFER_MAX_WORKERS', '1'))
+
+# If set, partial downloads are kept here (instead of the task's tempdir) so
+# a later attempt can resume them.
+SEEQ_DOWNLOAD_DIR = os.getenv('SEEQ_DOWNLOAD_DIR')
+# Seconds before an untouched partial download there is removed.
+SEEQ_PARTIAL_MAX_AGE = int(os.getenv('SEEQ_PARTIAL_MAX_AGE', '86400'))
+PRUNE_INTERVAL = 3600  # Seconds between checks for old partial downloads.
+# Connections tried per download before giving up.
+DOWNLOAD_ATTEMPTS = int(os.getenv('DOWNLOAD_ATTEMPTS', '5'))
+# Most bytes of downloads to keep on disk at once per process, 0 for no limit.
+TEMP_DISK_BUDGET = int(os.getenv('TEMP_DISK_BUDGET', '0'))
+# Seconds before retrying a transfer requested while a failed one ran.
+RERUN_DELAY = 60
+# Attempts at the S3 PUT of an upload before giving up.
+UPLOAD_ATTEMPTS = int(os.getenv('UPLOAD_ATTEMPTS', '3'))
+
+
+def is_md5(value):
+    return bool(re.match(r'^[0-9a-f]{32}$', value))
+
+
+def _md5_of_file(filepath):
     file_md5 = hashlib.md5()
     with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            file_md5.update(chunk)
+    return file_md5
+
+
+def get_md5(filepath):
+    with metrics.timed('md5'):
+        return _md5_of_file(filepath).hexdigest()
+
+
+def download_to_file(response, f, file_md5):
+    """
+    Append a streamed response to open file f, updating file_md5 as it goes.
+
+    Hashing while writing means the file doesn't need to be read back from
+    disk to build upload metadata.
+    """
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        if chunk:
+            f.write(chunk)
             file_md5.update(chunk)
-    return file_md5.hexdigest()
+            metrics.add_bytes('s3_download', len(chunk))
+            ratelimit.download_bandwidth.acquire(len(chunk))
+
+
+def _checkpoint_path(filepath):
+    return filepath + '.checkpoint'
+
+
+def remove_download(filepath):
+    """
+    Remove a downloaded file and its checkpoint, if present.
+    """
+    for path in (filepath, _checkpoint_path(filepath)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def download_resumable(url, response, filepath):
+    """
+    Download a Seeq file to filepath, resuming with HTTP Range requests.
+
+    response is the open GET for url, which must have a 200 status, as
+    seeq_file_to_oh checks. A partial file left at filepath by an
+    earlier attempt is resumed if its checkpoint matches the object's current
+    size and ETag. A dropped connection is resumed from the last byte written,
+    with up to DOWNLOAD_ATTEMPTS connections in total.
+
+    The result is checked against Content-Length, and against the ETag if it
+    is a plain MD5. Returns the file's MD5; raises IOError if the download
+    can't be completed or verified.
+    """
+    size = int(response.headers['Content-Length'])
+    raw_etag = response.headers.get('ETag')
+    checkpoint = {'size': size, 'etag': (raw_etag or '').strip('"')}
+    checkpoint_path = _checkpoint_path(filepath)
+    offset = 0
+    if os.path.exists(filepath) and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            if json.load(f) == checkpoint:
+                offset = min(os.path.getsize(filepath), size)
+    with open(checkpoint_path, 'w') as f:
+        json.dump(checkpoint, f)
+    if offset:
+        # Hash what earlier attempts already downloaded.
+        with open(filepath, 'r+b') as f:
+            f.truncate(offset)
+        file_md5 = _md5_of_file(filepath)
+        response.close()
+        response = None
+    else:
+        file_md5 = hashlib.md5()
+    attempts = 1
+    with open(filepath, 'ab' if offset else 'wb') as f:
+        while offset < size:
+            if response is None:
+                headers = {'Range': 'bytes={}-'.format(offset)}
+                if raw_etag:
+                    headers['If-Range'] = raw_etag
+                print('Resuming {} at byte {}...'.format(filepath, offset))
+                response = httpclient.get(url, stream=True, headers=headers)
+                if response.status_code != 206:
+                    # A 200 means the object changed since the checkpoint.
+                    response.close()
+                    remove_download(filepath)
+                    raise IOError('Bad response resuming download: {}'.format(
+                        response.status_code))
+            try:
+                download_to_file(response, f, file_md5)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError) as inst:
+                print('Download of {} interrupted: {!r}'.format(
+                    filepath, inst))
+            finally:
+                response.close()
+                response = None
+            f.flush()
+            offset = os.fstat(f.fileno()).st_size
+            if offset < size:
+                if attempts >= DOWNLOAD_ATTEMPTS:
+                    raise IOError('Gave up on {} at byte {} of {}'.format(
+                        filepath, offset, size))
+                attempts += 1
+    md5 = file_md5.hexdigest()
+    etag = checkpoint['etag']
+    if offset != size or (is_md5(etag) and etag != md5):
+        remove_download(filepath)
+        raise IOError('Download of {} failed verification'.format(filepath))
+    return md5
+
+
+class ResponseStream(object):
+    """
+    File-like wrapper around a streamed response with a known size.
+
+    Lets requests send it as an upload body with a Content-Length header (as
+    S3 requires), while it's read from the source connection in small blocks.
+    """
+    def __init__(self, response, size):
+        self._raw = response.raw
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def read(self, amt=CHUNK_SIZE):
+        return self._raw.read(amt, decode_content=True)
+
+
+def etag_md5(response):
+    """
+    Return the MD5 given by a response's S3 ETag, or None.
+
+    ETags of multipart S3 uploads aren't an MD5 of the content, and contain
+    a '-', so they're rejected by the pattern match.
+    """
+    etag = response.headers.get('ETag', '').strip('"')
+    if is_md5(etag):
+        return etag
+    return None
 
 
 def oh_upload_to_s3(oh_member, filepath, filename=None,
-                    tags=[], description=''):
+                    tags=[], description='', md5=None):
     """
     Upload a file to Open Humans S3 via three-step process.
 
+    If md5 is provided it is used as-is, otherwise it's computed from the file.
+    """
+    if not filename:
+        filename = os.path.basename(filepath)
+    if not md5:
+        md5 = get_md5(filepath)
+    with open(filepath, 'rb') as fh:
+        return oh_upload_stream_to_s3(oh_member=oh_member,
+                                      data=fh,
+                                      filename=filename,
+                                      md5=md5,
+                                      tags=tags,
+                                      description=description)
+
+
+def put_to_s3(url, data):
+    """
+    PUT data to a presigned S3 URL, retrying the PUT alone if it fails.
+
+    Only seekable data (e.g. an open file) can be sent again, so streamed
+    data gets a single attempt. The upload is held to UPLOAD_BYTES_PER_SEC.
+    Returns the last response, or raises the last connection error.
+    """
+    attempts = UPLOAD_ATTEMPTS if hasattr(data, 'seek') else 1
+    for attempt in range(1, attempts + 1):
+        if attempt > 1:
+            time.sleep(2 ** attempt)
+            data.seek(0)
+            print('Retrying upload to S3, attempt {}...'.format(attempt))
+        try:
+            response = httpclient.put(url, data=ratelimit.throttled(
+                data, ratelimit.upload_bandwidth))
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            if attempt == attempts:
+                raise
+            continue
+        if response.status_code < 500 or attempt == attempts:
+            return response
+
+
+def oh_upload_stream_to_s3(oh_member, data, filename, md5,
+                           tags=[], description=''):
+    """
+    Upload file data to Open Humans S3 via three-step process.
+
     Give Open Humans metadata and get an S3 upload URL from Open Humans.
-    Upload the file to this URL. Then notify Open Humans upload is done.
+    Upload the data to this URL. Then notify Open Humans upload is done,
+    and drop the member's cached Open Humans data.
+
+    Returns the Open Humans file ID if the upload completed, otherwise None.
     """
     upload_url = '{}/project/files/upload/direct/?access_token={}'.format(
         OH_API_BASE, oh_member.get_access_token())
-    if not filename:
-        filename = os.path.basename(filepath)
     metadata = {
         'tags': tags,
         'description': description,
-        'md5': get_md5(filepath),
+        'md5': md5,
     }
-    req1 = requests.post(
-        upload_url,
-        data={'project_member_id': oh_member.oh_id,
-              'filename': filename,
-              'metadata': json.dumps(metadata)})
+    with metrics.timed('oh_upload_direct'):
+        req1 = httpclient.api_request(
+            'oh_upload', 'POST', upload_url,
+            data={'project_member_id': oh_member.oh_id,
+                  'filename': filename,
+                  'metadata': json.dumps(metadata)})
     if req1.status_code != 201:
         print('Bad response in starting upload: {}'.format(req1.status_code))
         return
-    with open(filepath, 'rb') as fh:
-        req2 = requests.put(url=req1.json()['url'], data=fh)
+    upload_size = super_len(data)
+    with metrics.timed('s3_upload'):
+        req2 = put_to_s3(req1.json()['url'], data)
     if req2.status_code != 200:
         print('Bad response in upload to S3: {}'.format(req2.status_code))
         return
+    metrics.add_bytes('s3_upload', upload_size)
     complete_url = (
         '{}/project/files/upload/complete/?'
         'access_token={}'.format(OH_API_BASE, oh_member.get_access_token()))
-    req3 = requests.post(
-        complete_url,
-        data={'project_member_id': oh_member.oh_id,
-              'file_id': req1.json()['id']})
+    with metrics.timed('oh_upload_complete'):
+        req3 = httpclient.api_request(
+            'oh_upload', 'POST', complete_url,
+            data={'project_member_id': oh_member.oh_id,
+                  'file_id': req1.json()['id']})
     if req3.status_code != 200:
         print('Bad response in completing upload: {}'.format(req3.status_code))
-    else:
-        print('Upload complete for "{}".'.format(filename))
+        return
+    invalidate_member_data(oh_member.oh_id)
+    print('Upload complete for "{}".'.format(filename))
+    return req1.json()['id']
+
+
+class DiskBudget(object):
+    """
+    Limit the bytes of downloads on disk at once in this process.
+
+    acquire() waits until a download of the given size fits in the budget. A
+    file bigger than the whole budget is let through once nothing else is
+    on disk. A limit of 0 means no limit.
+
+    A partial download kept on disk to be resumed stays counted, under its
+    path, until that path is acquired again or forget() is called. Kept
+    partials never make acquire() wait: the oldest are deleted to make room
+    before waiting for active downloads.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._kept = OrderedDict()
+        self._condition = threading.Condition()
+
+    def acquire(self, size, name='', path=None):
+        if not self.limit:
+            return
+        with self._condition:
+            # The new download includes any partial kept at its path.
+            self.used -= self._kept.pop(path, 0)
+            waiting = False
+            while self.used and self.used + size > self.limit:
+                if self._kept:
+                    kept_path, kept = self._kept.popitem(last=False)
+                    print('Removing partial download {} to make room for '
+                          '{}.'.format(kept_path, name))
+                    remove_download(kept_path)
+                    self.used -= kept
+                    continue
+                if not waiting:
+                    print('Waiting for temp disk space for {}...'.format(
+                        name))
+                    waiting = True
+                self._condition.wait()
+            self.used += size
+
+    def release(self, size, path=None, kept=0):
+        """
+        Release a download's space, except kept bytes left at path.
+        """
+        if not self.limit:
+            return
+        with self._condition:
+            self.used -= size - kept
+            if kept:
+                self._kept[path] = kept
+            self._condition.notify_all()
+
+    def forget(self, path):
+        """
+        Stop counting a kept partial download, once it's removed.
+        """
+        if not self.limit:
+            return
+        with self._condition:
+            self.used -= self._kept.pop(path, 0)
+            self._condition.notify_all()
+
+
+disk_budget = DiskBudget(TEMP_DISK_BUDGET)
+_pruned = {'at': 0.0}
+
+
+def prune_partial_downloads():
+    """
+    Remove partial downloads untouched for SEEQ_PARTIAL_MAX_AGE seconds.
+
+    Checks SEEQ_DOWNLOAD_DIR at most once every PRUNE_INTERVAL seconds.
+    """
+    now = time.time()
+    if not SEEQ_DOWNLOAD_DIR or now - _pruned['at'] < PRUNE_INTERVAL:
+        return
+    _pruned['at'] = now
+    for dirpath, _, filenames in os.walk(SEEQ_DOWNLOAD_DIR):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                if now - os.path.getmtime(path) < SEEQ_PARTIAL_MAX_AGE:
+                    continue
+                if filename.endswith('.checkpoint'):
+                    if not os.path.exists(path[:-len('.checkpoint')]):
+                        os.remove(path)
+                    continue
+                print('Removing old partial download {}.'.format(path))
+                remove_download(path)
+            except OSError:
+                continue
+            disk_budget.forget(path)
+
+
+def seeq_filename_from_url(url):
+    return urlparse.urlsplit(url)[2].split('/')[-1]
+
+
+def seeq_file_size(item):
+    """
+    Return the size in bytes of a Seeq file in a raw data listing, or None.
+
+    Uses the listing's 'size' if Seeq gives one, otherwise Content-Length as
+    seeq_file_to_oh reads it. A HEAD request is tried first. Presigned S3
+    URLs may only allow GET, so if HEAD is refused a GET is opened and
+    closed after its headers, without reading the body.
+    """
+    if item.get('size') is not None:
+        return int(item['size'])
+    try:
+        response = httpclient.head(item['url_s3'])
+        if response.status_code != 200:
+            response = httpclient.get(item['url_s3'], stream=True)
+            response.close()
+    except requests.exceptions.RequestException as inst:
+        print('Could not get size of {}: {!r}'.format(
+            seeq_filename_from_url(item['url_s3']), inst))
+        return None
+    if (response.status_code != 200 or
+            'Content-Length' not in response.headers):
+        return None
+    return int(response.headers['Content-Length'])
+
+
+def xfer_result(filename, status, size=0, file_id=None, md5='', etag=''):
+    """
+    Describe the outcome of copying one Seeq file.
+
+    Status is one of 'copied', 'present', 'skipped' or 'failed'.
+    """
+    return {'filename': filename, 'status': status, 'bytes': size,
+            'file_id': file_id, 'md5': md5, 'etag': etag}
+
+
+def _get_seeq_file(url, seeq_filename):
+    """
+    Open a streamed GET for a Seeq file. Returns None unless it's a 200.
+    """
+    response = httpclient.get(url, stream=True)
+    if response.status_code != 200:
+        # e.g. an S3 XML error for an expired URL, not the file.
+        print('Bad response downloading Seeq file {}: {}'.format(
+            seeq_filename, response.status_code))
+        response.close()
+        return None
+    return response
 
 
 def seeq_file_to_oh(oh_member, seeq_data, tempdir):
     """
-    Copy a Seeq file to Open Humans.
+    Copy a Seeq file to Open Humans. Returns a result from xfer_result().
 
-    Somewhat inefficient: downloads a file from one S3 bucket and uploads to
-    another.
+    In 'disk' mode this downloads a file from one S3 bucket and uploads it to
+    another. In 'stream' mode the download is piped directly into the upload,
+    as long as the MD5 Open Humans needs is available before the transfer:
+    either provided by Seeq or taken from the S3 ETag. If it isn't, this
+    falls back to the 'disk' path.
     """
-    seeq_filename = urlparse.urlsplit(seeq_data['url_s3'])[2].split('/')[-1]
-    target_filepath = os.path.join(tempdir, seeq_filename)
-    response = requests.get(seeq_data['url_s3'], stream=True)
-    size = int(response.headers['Content-Length'])
+    seeq_filename = seeq_filename_from_url(seeq_data['url_s3'])
+    download_dir = tempdir
+    if SEEQ_DOWNLOAD_DIR:
+        download_dir = os.path.join(SEEQ_DOWNLOAD_DIR, oh_member.oh_id)
+        if not os.path.isdir(download_dir):
+            try:
+                os.makedirs(download_dir)
+            except OSError:
+                if not os.path.isdir(download_dir):
+                    raise
+    target_filepath = os.path.join(download_dir, seeq_filename)
+    response = None
+    if SEEQ_TRANSFER_MODE == 'stream' or not disk_budget.limit:
+        response = _get_seeq_file(seeq_data['url_s3'], seeq_filename)
+        if response is None:
+            return xfer_result(seeq_filename, 'failed')
+        size = int(response.headers['Content-Length'])
+    else:
+        # Found without opening the download, which would otherwise sit
+        # idle while waiting for disk space.
+        size = seeq_file_size(seeq_data)
+        if size is None:
+            print('Could not get size of Seeq file {}.'.format(seeq_filename))
+            return xfer_result(seeq_filename, 'failed')
     if size > MAX_FILESIZE:
         print("Skipping: Seeq file {} is larger than {} bytes".format(
             seeq_filename, MAX_FILESIZE))
-        return
-    print("Downloading {}...".format(seeq_filename))
-    with open(target_filepath, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
-    print("Uploading {}...".format(seeq_filename))
+        if response is not None:
+            response.close()
+        return xfer_result(seeq_filename, 'skipped')
     tags = ['seeq']
     if seeq_filename.endswith('.bam'):
         tags = tags + ['genome', 'microbiome', 'bam']
-    oh_upload_to_s3(oh_member=oh_member,
-                    filepath=target_filepath,
+    description = ('Seeq project raw data. Contains personal '
+                   'genetic and microbiome information.')
+    if SEEQ_TRANSFER_MODE == 'stream':
+        etag = response.headers.get('ETag', '').strip('"')
+        md5 = seeq_data.get('md5') or etag_md5(response)
+        if md5:
+            print("Streaming {} to Open Humans...".format(seeq_filename))
+            try:
+                file_id = oh_upload_stream_to_s3(
+                    oh_member=oh_member,
+                    data=ratelimit.throttled(
+                        ResponseStream(response, size),
+                        ratelimit.download_bandwidth),
                     filename=seeq_filename,
+                    md5=md5,
                     tags=tags,
-                    description=('Seeq project raw data. Contains personal '
-                                 'genetic and microbiome information.'))
+                    description=description)
+            finally:
+                response.close()
+            if file_id is None:
+                return xfer_result(seeq_filename, 'failed')
+            metrics.add_bytes('s3_download', size)
+            return xfer_result(seeq_filename, 'copied', size, file_id,
+                               md5=md5, etag=etag)
+        print("No MD5 known for {}, using tempdir.".format(seeq_filename))
+        if disk_budget.limit:
+            # Not held open while waiting for disk space.
+            response.close()
+            response = None
+    prune_partial_downloads()
+    disk_budget.acquire(size, seeq_filename, target_filepath)
+    result = None
+    try:
+        if response is None:
+            response = _get_seeq_file(seeq_data['url_s3'], seeq_filename)
+        if response is None:
+            result = xfer_result(seeq_filename, 'failed')
+            return result
+        etag = response.headers.get('ETag', '').strip('"')
+        print("Downloading {}...".format(seeq_filename))
+        try:
+            with metrics.timed('s3_download'):
+                md5 = download_resumable(seeq_data['url_s3'], response,
+                                         target_filepath)
+        except IOError as inst:
+            print("Download failed for Seeq file {}: {}".format(
+                seeq_filename, inst))
+            result = xfer_result(seeq_filename, 'failed')
+            return result
+        print("Uploading {}...".format(seeq_filename))
+        file_id = oh_upload_to_s3(oh_member=oh_member,
+                                  filepath=target_filepath,
+                                  filename=seeq_filename,
+                                  tags=tags,
+                                  description=description,
+                                  md5=md5)
+        if file_id is None:
+            result = xfer_result(seeq_filename, 'failed')
+        else:
+            result = xfer_result(seeq_filename, 'copied', size, file_id,
+                                 md5=md5, etag=etag)
+        return result
+    finally:
+        # Partial downloads in SEEQ_DOWNLOAD_DIR are kept to be resumed, and
+        # stay counted in the budget.
+        if (SEEQ_DOWNLOAD_DIR and not (result and result['status'] == 'copied')
+                and os.path.exists(target_filepath)):
+            disk_budget.release(size, target_filepath,
+                                os.path.getsize(target_filepath))
+        else:
+            remove_download(target_filepath)
+            disk_budget.release(size)
+
+
+def summarize_results(results):
+    """
+    Count files copied, bytes copied and failed copies in per-file results.
+    """
+    copied = [r for r in results if r['status'] == 'copied']
+    return {
+        'files': len(copied),
+        'bytes': sum(r['bytes'] for r in copied),
+        'failures': len([r for r in results if r['status'] == 'failed']),
+    }
 
 
-def dataxfer(oh_member, tempdir):
+def _copy_file(oh_member, item, tempdir, threaded=False):
+    """
+    Copy one Seeq file using its own directory inside tempdir.
+
+    Returns (result, exception). A private directory per file means parallel
+    copies never collide, and it's removed as soon as the copy is done.
+    Successful copies are recorded in the transfer ledger right away.
+    """
+    seeq_filename = seeq_filename_from_url(item['url_s3'])
+    print('Copying {} to Open Humans...'.format(seeq_filename))
+    file_tempdir = tempfile.mkdtemp(dir=tempdir)
+    try:
+        result = seeq_file_to_oh(oh_member, item, file_tempdir)
+        if result['status'] == 'copied':
+            SeeqFileTransfer.record(oh_member, result)
+        if result['status'] != 'failed':
+            oh_member.count_xfer_file()
+        return result, None
+    except Exception as inst:
+        print('Error copying {}: {!r}'.format(seeq_filename, inst))
+        return xfer_result(seeq_filename, 'failed'), inst
+    finally:
+        shutil.rmtree(file_tempdir, ignore_errors=True)
+        if threaded:
+            # Pool threads get their own DB connection, don't leave it open.
+            connection.close()
+
+
+# Set once Seeq's listings turn out to lack 'participant_id', after which
+# participants are always listed separately.
+_listing_fallback = {'per_participant': False}
+
+
+def seeq_raw_data_by_participant(seeq_ids):
+    """
+    Fetch raw data listings for several Seeq participants in one call.
+
+    Returns a dict of Seeq ID to listing. Items are grouped by their
+    'participant_id'. If Seeq leaves that out, each participant is listed
+    separately instead, for the rest of the process.
+    """
+    c = get_seeq_client()
+    seeq_ids = list(seeq_ids)
+    if len(seeq_ids) == 1 or _listing_fallback['per_participant']:
+        return {seeq_id: c.study_raw_data_get(SEEQ_STUDY_ID, [seeq_id])
+                for seeq_id in seeq_ids}
+    listings = {seeq_id: [] for seeq_id in seeq_ids}
+    items = c.study_raw_data_get(SEEQ_STUDY_ID, seeq_ids)
+    if any(item.get('participant_id') not in listings for item in items):
+        print('Seeq listings lack participant IDs. Listing participants '
+              'separately from now on.')
+        _listing_fallback['per_participant'] = True
+        return {seeq_id: c.study_raw_data_get(SEEQ_STUDY_ID, [seeq_id])
+                for seeq_id in seeq_ids}
+    for item in items:
+        listings[item['participant_id']].append(item)
+    return listings
+
+
+def dataxfer(oh_member, tempdir, max_workers=None, seeq_data=None):
     """
     Copy Seeq files into Open Humans if not already present.
 
-    Seeq filenames are used as Open Humans filenames. Check if a file with this
-    filename is already in Open Humans. If not, download from Seeq and upload
-    to Open Humans.
+    Only one transfer per member runs at a time, holding the member's
+    transfer lease. If another one holds it, this one is merged into it: the
+    running transfer checks Seeq again once done, and this returns an empty
+    list of results. If this fails with a rerun requested, a transfer task
+    is queued for it. See _dataxfer for the rest.
     """
-    c = seeq.client.Client(None)
-    c.set_refresh_token(SEEQ_REFRESH_TOKEN)
-    oh_data = oh_get_member_data(oh_member.get_access_token())
-    oh_filenames = [f['basename'] for f in oh_data['data']]
-    seeq_data = c.study_raw_data_get(SEEQ_STUDY_ID, [oh_member.seeq_id])
+    if not oh_member.acquire_xfer_lease():
+        print('Transfer already running for member {}, merged into '
+              'it.'.format(oh_member.oh_id))
+        return []
+    results = []
+    try:
+        while True:
+            results += _dataxfer(oh_member, tempdir, max_workers=max_workers,
+                                 seeq_data=seeq_data)
+            if not oh_member.release_xfer_lease():
+                return results
+            # Another transfer was requested meanwhile, so run it now.
+            print('Re-checking Seeq for member {}.'.format(oh_member.oh_id))
+            seeq_data = None
+            if not oh_member.acquire_xfer_lease():
+                return results
+    finally:
+        if oh_member.xfer_lease_owner and oh_member.release_xfer_lease():
+            # Don't lose requests merged into this failed transfer.
+            from .tasks import transfer_member
+            print('Queueing requested transfer for member {}.'.format(
+                oh_member.oh_id))
+            transfer_member.apply_async(args=[oh_member.oh_id],
+                                        countdown=RERUN_DELAY)
+
+
+def _dataxfer(oh_member, tempdir, max_workers=None, seeq_data=None):
+    """
+    Copy Seeq files into Open Humans if not already present.
+
+    Seeq filenames are used as Open Humans filenames. Files recorded in the
+    transfer ledger (SeeqFileTransfer) are skipped without asking Open Humans.
+    If any others remain, check if a file with this filename is already in
+    Open Humans. If not, download from Seeq and upload to Open Humans. Up to
+    max_workers files (default DATAXFER_MAX_WORKERS) are copied at once.
+
+    seeq_data is the member's raw data listing, if already fetched (e.g. by
+    seeq_raw_data_by_participant). As its download URLs may have expired, the
+    listing is fetched again before copying anything.
+
+    Returns a list of per-file results (see xfer_result). If any copy raised
+    an exception, the first one is re-raised once all copies have finished.
+    """
+    if max_workers is None:
+        max_workers = DATAXFER_MAX_WORKERS
+    prefetched = seeq_data is not None
+    if not prefetched:
+        seeq_data = seeq_raw_data_by_participant(
+            [oh_member.seeq_id])[oh_member.seeq_id]
+    recorded = set(SeeqFileTransfer.objects.filter(
+        member=oh_member).values_list('seeq_filename', flat=True))
+    results = []
+    new_filenames = set()
     for item in seeq_data:
-        seeq_filename = urlparse.urlsplit(item['url_s3'])[2].split('/')[-1]
-        if seeq_filename not in oh_filenames:
-            print('Copying {} to Open Humans...'.format(seeq_filename))
-            seeq_file_to_oh(oh_member, item, tempdir)
+        seeq_filename = seeq_filename_from_url(item['url_s3'])
+        if seeq_filename in recorded:
+            results.append(xfer_result(seeq_filename, 'present'))
+        else:
+            new_filenames.add(seeq_filename)
+    if not new_filenames:
+        print('No new Seeq files for member {}.'.format(oh_member.oh_id))
+        oh_member.set_xfer_status('done', files_total=len(results),
+                                  files_done=len(results))
+        return results
+    if prefetched:
+        seeq_data = seeq_raw_data_by_participant(
+            [oh_member.seeq_id])[oh_member.seeq_id]
+    new_items = [item for item in seeq_data if
+                 seeq_filename_from_url(item['url_s3']) in new_filenames]
+    oh_data = oh_get_member_data(oh_member.get_access_token(),
+                                 oh_id=oh_member.oh_id)
+    oh_files = {f['basename']: f for f in oh_data['data']}
+    to_copy = []
+    for item in new_items:
+        seeq_filename = seeq_filename_from_url(item['url_s3'])
+        if seeq_filename not in oh_files:
+            to_copy.append(item)
         else:
             print('File "{}" already in Open Humans.'.format(seeq_filename))
+            result = xfer_result(seeq_filename, 'present',
+                                 file_id=oh_files[seeq_filename].get('id'))
+            SeeqFileTransfer.record(oh_member, result)
+            results.append(result)
+    oh_member.set_xfer_status('running',
+                              files_total=len(results) + len(to_copy),
+                              files_done=len(results))
+    if max_workers > 1 and len(to_copy) > 1:
+        pool = ThreadPool(min(max_workers, len(to_copy)))
+        try:
+            copied = pool.map(
+                lambda item: _copy_file(oh_member, item, tempdir,
+                                        threaded=True),
+                to_copy)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        copied = [_copy_file(oh_member, item, tempdir) for item in to_copy]
+    results += [result for result, _ in copied]
+    errors = [inst for _, inst in copied if inst is not None]
+    if errors or any(r['status'] == 'failed' for r in results):
+        oh_member.set_xfer_status('failed')
+    else:
+        oh_member.set_xfer_status('done')
+    if errors:
+        raise errors[0]
+    return results
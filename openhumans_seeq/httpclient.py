@@ -0,0 +1,112 @@
+"""
+Shared HTTP session for calls to Open Humans and Seeq's S3 storage.
+
+Reusing one session per process keeps connections alive between calls, so
+each request doesn't pay for a new TCP and TLS handshake. Requests get
+default connect/read timeouts, and idempotent requests (GET and HEAD) are
+retried with backoff on connection errors and 5xx responses.
+
+Open Humans API calls go through api_request(), which applies the rate
+limits in ratelimit and retries calls answered with 429.
+"""
+from __future__ import print_function
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from . import ratelimit
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '60'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))  # Per host.
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '3'))
+# Make requests wait for a free connection rather than exceed the pool size,
+# e.g. to cap connections per host when syncing with many threads.
+HTTP_POOL_BLOCK = os.getenv('HTTP_POOL_BLOCK', '').lower() == 'true'
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    """
+    Session that applies default timeouts to every request.
+    """
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        return super(TimeoutSession, self).request(method, url, **kwargs)
+
+
+def _new_session():
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        method_whitelist=frozenset(['GET', 'HEAD']),
+        raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4,
+                          pool_maxsize=HTTP_POOL_SIZE,
+                          pool_block=HTTP_POOL_BLOCK,
+                          max_retries=retry)
+    session = TimeoutSession()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Return this process's shared session, creating it if needed.
+
+    A new session is made after a fork (e.g. in Celery worker processes), so
+    pooled connections are never shared between processes.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = _new_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+def get(url, **kwargs):
+    return get_session().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    return get_session().head(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return get_session().post(url, **kwargs)
+
+
+def put(url, **kwargs):
+    return get_session().put(url, **kwargs)
+
+
+def api_request(family, method, url, **kwargs):
+    """
+    Make an API call under the rate limit for its family of endpoints.
+
+    A 429 response slows the family's limiter and the call is tried again,
+    up to HTTP_RETRIES times. Returns the last response.
+    """
+    limiter = ratelimit.api_limiters[family]
+    for attempt in range(HTTP_RETRIES + 1):
+        limiter.acquire()
+        response = get_session().request(method, url, **kwargs)
+        if response.status_code != 429:
+            limiter.succeeded()
+            return response
+        retry_after = ratelimit.parse_retry_after(
+            response.headers.get('Retry-After'))
+        print('Throttled by {} API, attempt {}.'.format(family, attempt + 1))
+        limiter.throttled(retry_after)
+    return response
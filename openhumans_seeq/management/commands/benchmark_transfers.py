@@ -0,0 +1,124 @@
+from __future__ import print_function
+
+from datetime import timedelta
+import shutil
+import tempfile
+import time
+
+import arrow
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from openhumans_seeq import utils
+from openhumans_seeq.benchmark import (DiskMonitor, FakeSeeqClient,
+                                       FakeServices, peak_rss)
+from openhumans_seeq.dataxfer import dataxfer
+from openhumans_seeq.models import OpenHumansMember
+from openhumans_seeq.tasks import init_xfer_to_open_humans
+
+
+class Command(BaseCommand):
+    help = ('Benchmark Seeq to Open Humans transfers against local stand-ins '
+            'for Open Humans, Seeq and S3. Needs an empty database and '
+            'OH_BASE_URL set to http://127.0.0.1:<port>/.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path', choices=['sync_all', 'dataxfer', 'init_xfer'],
+            default='sync_all', help='Code path to run (default: sync_all).')
+        parser.add_argument(
+            '--engine', choices=['serial', 'threads'], default='serial',
+            help='sync_all engine to use (default: serial).')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--members', type=int, default=10)
+        parser.add_argument('--files', type=int, default=2,
+                            help='Seeq files per member (default: 2).')
+        parser.add_argument('--file-size', type=int, default=10000000,
+                            help='Bytes per Seeq file (default: 10000000).')
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='Seconds added to each request.')
+        parser.add_argument('--bandwidth', type=int, default=0,
+                            help='Bytes/second per connection, 0 for no cap.')
+        parser.add_argument('--expired-tokens', action='store_true',
+                            help='Start members with expired tokens, so '
+                                 'each one is refreshed.')
+
+    def _create_members(self, count, linked, expired):
+        expires_in = -3600 if expired else 36000
+        seeq_members = {}
+        for n in range(count):
+            oh_id = 'bench-{}'.format(n)
+            seeq_id = 900000 + n
+            OpenHumansMember.objects.create(
+                oh_id=oh_id,
+                access_token='bench-token-{}'.format(oh_id),
+                refresh_token='bench-refresh-{}'.format(oh_id),
+                token_expires=(arrow.now() +
+                               timedelta(seconds=expires_in)).datetime,
+                seeq_id=seeq_id if linked else None)
+            seeq_members[seeq_id] = oh_id
+        return seeq_members
+
+    def _run(self, path, engine):
+        if path == 'sync_all':
+            call_command('sync_all', engine=engine)
+        elif path == 'dataxfer':
+            tempdir = tempfile.mkdtemp()
+            try:
+                for oh_member in OpenHumansMember.objects.all():
+                    dataxfer(oh_member, tempdir=tempdir)
+            finally:
+                shutil.rmtree(tempdir)
+        else:
+            for oh_id in OpenHumansMember.objects.values_list(
+                    'oh_id', flat=True):
+                init_xfer_to_open_humans(oh_id)
+
+    def handle(self, *args, **options):
+        services = FakeServices(port=options['port'],
+                                latency=options['latency'],
+                                bandwidth=options['bandwidth'],
+                                file_size=options['file_size'])
+        if utils.OH_BASE_URL != services.base_url:
+            raise CommandError('Run with OH_BASE_URL={}'.format(
+                services.base_url))
+        if OpenHumansMember.objects.exists():
+            raise CommandError('The benchmark needs an empty database.')
+        seeq_members = self._create_members(
+            options['members'], linked=options['path'] != 'sync_all',
+            expired=options['expired_tokens'])
+        utils.set_seeq_client(FakeSeeqClient(
+            services, seeq_members, options['files']))
+        benchdir = tempfile.mkdtemp()
+        default_tempdir = tempfile.tempdir
+        tempfile.tempdir = benchdir
+        services.start()
+        try:
+            with DiskMonitor(benchdir) as disk:
+                start = time.time()
+                self._run(options['path'], options['engine'])
+                elapsed = time.time() - start
+        finally:
+            services.stop()
+            tempfile.tempdir = default_tempdir
+            shutil.rmtree(benchdir)
+            utils.set_seeq_client(None)
+            OpenHumansMember.objects.filter(
+                oh_id__in=list(seeq_members.values())).delete()
+            # The stand-in's uploads are gone once it stops.
+            for oh_id in seeq_members.values():
+                utils.invalidate_member_data(oh_id)
+        files = sum(len(services.uploaded_files(oh_id))
+                    for oh_id in seeq_members.values())
+        megabytes = services.bytes_put / 1000000.0
+        print('Path: {}, {} members x {} files of {} bytes.'.format(
+            options['path'], options['members'], options['files'],
+            options['file_size']))
+        print('Elapsed: {:.2f}s'.format(elapsed))
+        print('Files copied: {} ({:.2f} files/sec)'.format(
+            files, files / elapsed))
+        print('Uploaded: {:.1f} MB ({:.2f} MB/sec)'.format(
+            megabytes, megabytes / elapsed))
+        print('Peak RSS: {:.1f} MB'.format(peak_rss() / 1000000.0))
+        print('Temp disk high-water mark: {:.1f} MB'.format(
+            disk.high_water / 1000000.0))
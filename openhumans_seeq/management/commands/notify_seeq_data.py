@@ -0,0 +1,40 @@
+from __future__ import print_function
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from openhumans_seeq import httpclient
+from openhumans_seeq.views import OHSEEQ_BASE_URL, SEEQ_NOTIFY_SECRET
+
+
+class Command(BaseCommand):
+    help = ('Act as Seeq, notifying this app of new raw data for Seeq '
+            'participants. For local testing of the seeq/notify endpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('participant_ids', nargs='+', type=int,
+                            help='Seeq participant IDs to notify about.')
+        parser.add_argument(
+            '--url', default='{}seeq/notify/'.format(OHSEEQ_BASE_URL),
+            help='Notification endpoint (default: OHSEEQ_BASE_URL + '
+                 'seeq/notify/).')
+        parser.add_argument(
+            '--repeat', type=int, default=1,
+            help='Notifications per participant, to simulate a burst '
+                 '(default: 1).')
+        parser.add_argument('--interval', type=float, default=0.0,
+                            help='Seconds between notifications.')
+
+    def handle(self, *args, **options):
+        if not SEEQ_NOTIFY_SECRET:
+            raise CommandError('Set SEEQ_NOTIFY_SECRET to send '
+                               'notifications.')
+        for _ in range(options['repeat']):
+            for seeq_id in options['participant_ids']:
+                response = httpclient.post(
+                    options['url'], json={'participant_id': seeq_id},
+                    headers={'X-Seeq-Notify-Secret': SEEQ_NOTIFY_SECRET})
+                print('Participant {}: {} {}'.format(
+                    seeq_id, response.status_code, response.text))
+                time.sleep(options['interval'])
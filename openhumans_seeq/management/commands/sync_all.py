@@ -1,35 +1,367 @@
 from __future__ import print_function
 
+from collections import deque
+import heapq
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
 import tempfile
+import time
+import zlib
 
-from django.core.management.base import BaseCommand
+import arrow
+from arrow.parser import ParserError
+from celery.backends.base import DisabledBackend
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 
-from openhumans_seeq.dataxfer import dataxfer
-from openhumans_seeq.models import OpenHumansMember
+from openhumans_seeq import metrics
+from openhumans_seeq.celery import app
+from openhumans_seeq.dataxfer import (MAX_FILESIZE, SEEQ_LISTING_CHUNK,
+                                      dataxfer, seeq_file_size,
+                                      seeq_filename_from_url,
+                                      seeq_raw_data_by_participant,
+                                      summarize_results)
+from openhumans_seeq.models import OpenHumansMember, SeeqFileTransfer
+from openhumans_seeq.tasks import xfer_to_open_humans
 
 SEEQ_REFRESH_TOKEN = os.getenv('SEEQ_REFRESH_TOKEN')
 SEEQ_STUDY_ID = int(os.getenv('SEEQ_STUDY_ID'))
 
+POLL_INTERVAL = 5  # Seconds between checks on distributed transfers.
+PLAN_CONCURRENCY = 8  # Seeq file sizes looked up at once while planning.
+MEMBER_PAGE_SIZE = 500  # Members loaded per database query.
+
+
+def shard_of(oh_id, shards):
+    """
+    Return the shard (0 to shards - 1) of a member, stable across machines.
+    """
+    return (zlib.crc32(oh_id.encode('utf-8')) & 0xffffffff) % shards
+
 
 class Command(BaseCommand):
     help = 'Sync all current Seeq data for Open Humans members.'
 
-    def _sync_all(self, tempdir):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--distributed', action='store_true',
+            help='Run one Celery task per member instead of syncing here. '
+                 'Requires CELERY_RESULT_BACKEND to be set.')
+        parser.add_argument(
+            '--engine', choices=['serial', 'threads'], default='serial',
+            help="How to sync here: one member at a time, or 'threads' to "
+                 "run several members' transfers at once in this process.")
+        parser.add_argument(
+            '--concurrency', type=int, default=8,
+            help='With --engine=threads, the most members synced at once '
+                 '(default: 8). Set HTTP_POOL_BLOCK=true to also cap '
+                 'connections per host at HTTP_POOL_SIZE.')
+        parser.add_argument(
+            '--max-in-flight', type=int, default=4,
+            help='With --distributed, the most member transfers queued or '
+                 'running at once (default: 4).')
+        parser.add_argument(
+            '--task-timeout', type=int, default=6 * 60 * 60,
+            help='With --distributed, seconds to wait for a member transfer '
+                 'before counting it as failed (default: 21600).')
+        parser.add_argument(
+            '--shard', default='0/1',
+            help="Only sync shard i of n, as 'i/n' with i from 0 to n-1, so "
+                 "n machines can split a sync. Members are assigned by a "
+                 "hash of their Open Humans ID.")
+        parser.add_argument(
+            '--members',
+            help='Only sync these Open Humans member IDs, comma-separated.')
+        parser.add_argument(
+            '--since',
+            help='Only sync members who joined at or after this date or '
+                 'time, e.g. 2017-03-01. Join dates are only recorded for '
+                 'members who joined after the created field was added, so '
+                 'earlier members are always left out.')
+        parser.add_argument(
+            '--plan-only', action='store_true',
+            help='Print the files and bytes to transfer and an estimated '
+                 'run time, without transferring anything.')
+        parser.add_argument(
+            '--worker-bytes-per-sec', type=int, default=10000000,
+            help='Transfer rate per worker assumed by the --plan-only '
+                 'estimate (default: 10000000).')
+
+    @staticmethod
+    def _new_totals():
+        return {'members': 0, 'member_failures': 0,
+                'files': 0, 'bytes': 0, 'failures': 0}
+
+    @staticmethod
+    def _add_summary(totals, summary):
+        totals['members'] += 1
+        for key in ('files', 'bytes', 'failures'):
+            totals[key] += summary[key]
+
+    @staticmethod
+    def _print_totals(totals):
+        print('Synced {} members ({} failed): {} files copied, {} bytes, '
+              '{} file failures.'.format(
+                  totals['members'], totals['member_failures'],
+                  totals['files'], totals['bytes'], totals['failures']))
+
+    @staticmethod
+    def _sync_member(tempdir, member_plan):
+        """
+        Sync one member on a pool thread. Returns (oh_member, summary, error).
+
+        member_plan is one member's entry from _plan.
+        """
+        oh_member = member_plan['member']
+        print('Syncing member {}...'.format(oh_member.oh_id))
+        try:
+            results = dataxfer(oh_member, tempdir=tempdir,
+                               seeq_data=member_plan['listing'])
+            return oh_member, summarize_results(results), None
+        except Exception as inst:
+            return oh_member, None, inst
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _iter_members(shard, shards, oh_ids=None, since=None):
+        """
+        Yield members with a Seeq ID in this shard, a page at a time.
+
+        Pages are fetched in oh_id order, each starting after the last ID
+        of the one before (keyset pagination), so memory use stays flat.
+        """
+        members = OpenHumansMember.objects.filter(
+            seeq_id__isnull=False).order_by('oh_id')
+        if oh_ids:
+            members = members.filter(oh_id__in=oh_ids)
+        if since:
+            members = members.filter(created__gte=since)
+        last_oh_id = None
+        while True:
+            page = members
+            if last_oh_id is not None:
+                page = page.filter(oh_id__gt=last_oh_id)
+            page = list(page[:MEMBER_PAGE_SIZE])
+            if not page:
+                return
+            last_oh_id = page[-1].oh_id
+            for oh_member in page:
+                if shard_of(oh_member.oh_id, shards) == shard:
+                    yield oh_member
+
+    @staticmethod
+    def _plan(oh_members):
+        """
+        Find each member's files not yet in the ledger, and their sizes.
+
+        oh_members is an iterable of members with Seeq IDs, read
+        SEEQ_LISTING_CHUNK at a time. Returns (plan, members checked). The
+        plan has one entry per member with pending files: its 'member', raw
+        data 'listing', and pending 'files' and 'bytes', largest first.
+        Running them in this order over a pool of workers is longest
+        processing time (LPT) scheduling. Files over MAX_FILESIZE, which
+        are skipped, and files whose size can't be found count as 0 bytes.
+        """
+        plan = []
+        pending = []
+        checked = 0
+        oh_members = iter(oh_members)
+        while True:
+            chunk = list(islice(oh_members, SEEQ_LISTING_CHUNK))
+            if not chunk:
+                break
+            checked += len(chunk)
+            listings = seeq_raw_data_by_participant(
+                [m.seeq_id for m in chunk])
+            recorded = set(SeeqFileTransfer.objects.filter(
+                member__in=[m.oh_id for m in chunk]).values_list(
+                    'member_id', 'seeq_filename'))
+            for oh_member in chunk:
+                member_plan = {'member': oh_member,
+                               'listing': listings[oh_member.seeq_id],
+                               'files': 0, 'bytes': 0}
+                for item in member_plan['listing']:
+                    if (oh_member.oh_id, seeq_filename_from_url(
+                            item['url_s3'])) not in recorded:
+                        member_plan['files'] += 1
+                        pending.append((member_plan, item))
+                if member_plan['files']:
+                    plan.append(member_plan)
+        pool = ThreadPool(PLAN_CONCURRENCY)
+        try:
+            sizes = pool.map(lambda args: seeq_file_size(args[1]), pending)
+        finally:
+            pool.close()
+            pool.join()
+        for (member_plan, _), size in zip(pending, sizes):
+            if size and size <= MAX_FILESIZE:
+                member_plan['bytes'] += size
+        plan.sort(key=lambda member_plan: member_plan['bytes'], reverse=True)
+        return plan, checked
+
+    @staticmethod
+    def _print_plan(plan, members, workers, worker_bytes_per_sec):
+        """
+        Print planned totals and the LPT makespan estimate for workers.
+        """
+        loads = [0] * workers
+        for member_plan in plan:
+            heapq.heapreplace(loads, loads[0] + member_plan['bytes'])
+        print('Plan: {} of {} members have {} new files, {} bytes.'.format(
+            len(plan), members, sum(p['files'] for p in plan),
+            sum(p['bytes'] for p in plan)))
+        for member_plan in plan:
+            print('  {}: {} files, {} bytes'.format(
+                member_plan['member'].oh_id, member_plan['files'],
+                member_plan['bytes']))
+        print('Estimated makespan with {} workers: {} bytes on the busiest, '
+              'about {:.0f}s at {} bytes/sec each.'.format(
+                  workers, max(loads),
+                  max(loads) / float(worker_bytes_per_sec),
+                  worker_bytes_per_sec))
+
+    def _sync_all(self, tempdir, plan, engine='serial', concurrency=1):
         print('Syncing member data using tempdir "{}"...'.format(tempdir))
-        OpenHumansMember.update_seeq_ids()
-        for oh_member in OpenHumansMember.objects.all():
-            print('Syncing member {}...'.format(oh_member.oh_id))
-            if not oh_member.seeq_id:
-                print('Member {} has no corresponding Seeq ID.')
-                continue
-            dataxfer(oh_member, tempdir=tempdir)
+        totals = self._new_totals()
+        if engine == 'threads':
+            pool = ThreadPool(concurrency)
+            try:
+                # Members are handed to free threads one at a time, in the
+                # plan's largest-first order.
+                synced = pool.imap_unordered(
+                    lambda member_plan: self._sync_member(
+                        tempdir, member_plan), plan)
+                for oh_member, summary, error in synced:
+                    if error is None:
+                        self._add_summary(totals, summary)
+                        continue
+                    print('Transfer failed for member {}: {!r}'.format(
+                        oh_member.oh_id, error))
+                    totals['members'] += 1
+                    totals['member_failures'] += 1
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for member_plan in plan:
+                oh_member = member_plan['member']
+                print('Syncing member {}...'.format(oh_member.oh_id))
+                results = dataxfer(oh_member, tempdir=tempdir,
+                                   seeq_data=member_plan['listing'])
+                self._add_summary(totals, summarize_results(results))
+        self._print_totals(totals)
+
+    def _sync_all_distributed(self, plan, max_in_flight, task_timeout):
+        """
+        Queue a transfer task per member, with at most max_in_flight at once.
+
+        A task without a result after task_timeout seconds (e.g. lost with
+        its worker) is counted as a failed member and no longer waited on.
+        """
+        pending = deque(plan)
+        print('Queueing transfers for {} members...'.format(len(pending)))
+        totals = self._new_totals()
+        in_flight = []
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                member_plan = pending.popleft()
+                oh_id = member_plan['member'].oh_id
+                result = xfer_to_open_humans.delay(
+                    oh_id, seeq_data=member_plan['listing'])
+                in_flight.append((oh_id, time.time(), result))
+            time.sleep(POLL_INTERVAL)
+            still_running = []
+            for oh_id, queued, result in in_flight:
+                if not result.ready():
+                    if time.time() - queued < task_timeout:
+                        still_running.append((oh_id, queued, result))
+                        continue
+                    print('Transfer for member {} timed out.'.format(oh_id))
+                    totals['members'] += 1
+                    totals['member_failures'] += 1
+                elif result.successful():
+                    self._add_summary(totals, result.result)
+                else:
+                    print('Transfer failed for member {}: {!r}'.format(
+                        oh_id, result.result))
+                    totals['members'] += 1
+                    totals['member_failures'] += 1
+            in_flight = still_running
+        self._print_totals(totals)
 
     def handle(self, *args, **options):
+        metrics.start_task()
+        try:
+            self._handle(**options)
+        finally:
+            metrics.finish_task('sync_all')
+
+    def _handle(self, **options):
+        if options['distributed']:
+            if (isinstance(app.backend, DisabledBackend) and
+                    not options['plan_only']):
+                raise CommandError('--distributed needs CELERY_RESULT_BACKEND '
+                                   'to collect transfer results.')
+            if options['max_in_flight'] < 1:
+                raise CommandError('--max-in-flight must be at least 1.')
+            if options['task_timeout'] < 1:
+                raise CommandError('--task-timeout must be at least 1.')
+            workers = options['max_in_flight']
+        else:
+            if options['concurrency'] < 1:
+                raise CommandError('--concurrency must be at least 1.')
+            workers = 1
+            if options['engine'] == 'threads':
+                workers = options['concurrency']
+        if options['worker_bytes_per_sec'] < 1:
+            raise CommandError('--worker-bytes-per-sec must be at least 1.')
+        try:
+            shard, shards = [int(n) for n in options['shard'].split('/')]
+        except ValueError:
+            raise CommandError("--shard must look like 'i/n', e.g. '0/4'.")
+        if not 0 <= shard < shards:
+            raise CommandError('--shard i/n needs 0 <= i < n.')
+        oh_ids = None
+        if options['members']:
+            oh_ids = [oh_id.strip() for oh_id in
+                      options['members'].split(',') if oh_id.strip()]
+        since = None
+        if options['since']:
+            try:
+                since = arrow.get(options['since']).datetime
+            except ParserError:
+                raise CommandError('Could not parse --since date: {}'.format(
+                    options['since']))
+        counts = OpenHumansMember.update_seeq_ids()
+        print('Seeq IDs: {matched} matched, {updated} updated, '
+              '{unknown} unknown.'.format(**counts))
+        print('{} members have no corresponding Seeq ID.'.format(
+            OpenHumansMember.objects.filter(seeq_id__isnull=True).count()))
+        if since:
+            undated = OpenHumansMember.objects.filter(
+                seeq_id__isnull=False, created__isnull=True).count()
+            if undated:
+                print('Warning: --since leaves out {} members with no '
+                      'recorded join date.'.format(undated))
+        if shards > 1:
+            print('Syncing shard {} of {}.'.format(shard, shards))
+        plan, checked = self._plan(self._iter_members(
+            shard, shards, oh_ids=oh_ids, since=since))
+        self._print_plan(plan, checked, workers,
+                         options['worker_bytes_per_sec'])
+        if options['plan_only']:
+            return
+        if options['distributed']:
+            self._sync_all_distributed(plan, options['max_in_flight'],
+                                       options['task_timeout'])
+            return
         tempdir = tempfile.mkdtemp()
         try:
-            self._sync_all(tempdir)
+            self._sync_all(tempdir, plan, engine=options['engine'],
+                           concurrency=options['concurrency'])
         except Exception as inst:
             shutil.rmtree(tempdir)
             raise inst
@@ -0,0 +1,181 @@
+"""
+Timing and byte counters for transfer phases.
+
+Counters are kept per process, and per Celery task while one is running
+(see start_task and finish_task). Worker processes publish their counters
+to Django's cache after each task, so the metrics view can report every
+process in Prometheus text format.
+
+When METRICS_ENABLED isn't set, timed() returns a shared no-op context
+manager and add_bytes() returns immediately.
+"""
+from __future__ import print_function
+
+import os
+import socket
+import threading
+import time
+
+from django.core.cache import cache
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '').lower() == 'true'
+# Published snapshots expire, freeing their slot, if their process stops
+# updating them. Each publish renews the snapshot.
+METRICS_TTL = 60 * 60
+MAX_PROCESSES = 64
+
+_lock = threading.Lock()
+_process_stats = {}
+_task_stats = None
+_slot = {'pid': None, 'key': None}
+
+
+def _record(phase, seconds=0.0, size=0, calls=0):
+    with _lock:
+        for stats in (_process_stats, _task_stats):
+            if stats is None:
+                continue
+            phase_stats = stats.setdefault(
+                phase, {'calls': 0, 'seconds': 0.0, 'bytes': 0})
+            phase_stats['calls'] += calls
+            phase_stats['seconds'] += seconds
+            phase_stats['bytes'] += size
+
+
+class _Timer(object):
+    __slots__ = ('phase', 'start')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record(self.phase, seconds=time.time() - self.start, calls=1)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timed(phase):
+    """
+    Return a context manager that times one call of a phase.
+    """
+    if not METRICS_ENABLED:
+        return _NULL_TIMER
+    return _Timer(phase)
+
+
+def add_bytes(phase, size):
+    if METRICS_ENABLED:
+        _record(phase, size=size)
+
+
+def snapshot():
+    with _lock:
+        return {phase: dict(stats) for phase, stats in _process_stats.items()}
+
+
+def _process_name():
+    return '{}:{}'.format(os.getenv('DYNO') or socket.gethostname(),
+                          os.getpid())
+
+
+def start_task():
+    """
+    Start collecting counters for a task running in this process.
+    """
+    global _task_stats
+    if METRICS_ENABLED:
+        with _lock:
+            _task_stats = {}
+
+
+def finish_task(name):
+    """
+    Print the counters collected for a task and publish process counters.
+    """
+    global _task_stats
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        stats, _task_stats = _task_stats or {}, None
+    for phase in sorted(stats):
+        print('Task {} {}: {calls} calls, {seconds:.2f}s, '
+              '{bytes} bytes'.format(name, phase, **stats[phase]))
+    publish()
+
+
+def _slot_key():
+    """
+    Claim a cache key for this process's snapshot, the first free slot.
+
+    The slot is claimed again if it expired and another process took it,
+    and claiming is retried on later publishes if every slot was taken.
+    """
+    if _slot['pid'] == os.getpid() and _slot['key']:
+        published = cache.get(_slot['key'])
+        if not published or published['process'] != _process_name():
+            _slot['pid'] = None
+    if _slot['pid'] != os.getpid() or not _slot['key']:
+        _slot['pid'], _slot['key'] = os.getpid(), None
+        for n in range(MAX_PROCESSES):
+            key = 'metrics:process:{}'.format(n)
+            if cache.add(key, {'process': _process_name(), 'stats': {}},
+                         METRICS_TTL):
+                _slot['key'] = key
+                break
+    return _slot['key']
+
+
+def publish():
+    """
+    Save this process's counters to the cache for the metrics view.
+    """
+    if not METRICS_ENABLED:
+        return
+    key = _slot_key()
+    if key:
+        cache.set(key, {'process': _process_name(), 'stats': snapshot()},
+                  METRICS_TTL)
+
+
+def unpublish():
+    """
+    Free this process's snapshot slot, e.g. when the process exits.
+    """
+    if not METRICS_ENABLED:
+        return
+    if _slot['pid'] == os.getpid() and _slot['key']:
+        cache.delete(_slot['key'])
+        _slot['key'] = None
+
+
+def render_prometheus():
+    """
+    Return counters for all published processes in Prometheus text format.
+    """
+    processes = {_process_name(): snapshot()}
+    keys = ['metrics:process:{}'.format(n) for n in range(MAX_PROCESSES)]
+    for published in cache.get_many(keys).values():
+        processes.setdefault(published['process'], published['stats'])
+    lines = []
+    for field in ('calls', 'seconds', 'bytes'):
+        name = 'ohseeq_phase_{}_total'.format(field)
+        lines.append('# TYPE {} counter'.format(name))
+        for process in sorted(processes):
+            stats = processes[process]
+            for phase in sorted(stats):
+                lines.append('{}{{process="{}",phase="{}"}} {}'.format(
+                    name, process, phase, stats[phase][field]))
+    return '\n'.join(lines) + '\n'
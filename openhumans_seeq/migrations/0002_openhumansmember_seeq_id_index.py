@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openhumans_seeq', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='openhumansmember',
+            name='seeq_id',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+    ]
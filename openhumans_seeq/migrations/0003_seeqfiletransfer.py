@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openhumans_seeq', '0002_openhumansmember_seeq_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeeqFileTransfer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seeq_filename', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField(null=True)),
+                ('etag', models.CharField(blank=True, max_length=64)),
+                ('md5', models.CharField(blank=True, max_length=32)),
+                ('oh_file_id', models.IntegerField(null=True)),
+                ('transferred', models.DateTimeField(auto_now=True)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='seeq_files', to='openhumans_seeq.OpenHumansMember')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='seeqfiletransfer',
+            unique_together=set([('member', 'seeq_filename')]),
+        ),
+    ]
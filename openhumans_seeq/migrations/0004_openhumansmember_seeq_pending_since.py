@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openhumans_seeq', '0003_seeqfiletransfer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='openhumansmember',
+            name='seeq_pending_since',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
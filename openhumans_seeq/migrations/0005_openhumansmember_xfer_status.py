@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openhumans_seeq', '0004_openhumansmember_seeq_pending_since'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='openhumansmember',
+            name='xfer_files_done',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='openhumansmember',
+            name='xfer_files_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='openhumansmember',
+            name='xfer_status',
+            field=models.CharField(blank=True, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='openhumansmember',
+            name='xfer_updated',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openhumans_seeq', '0005_openhumansmember_xfer_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='openhumansmember',
+            name='xfer_lease_expires',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='openhumansmember',
+            name='xfer_lease_owner',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='openhumansmember',
+            name='xfer_rerun',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openhumans_seeq', '0006_openhumansmember_xfer_lease'),
+    ]
+
+    operations = [
+        # Added without auto_now_add first, which would otherwise fill in
+        # the migration time for existing members.
+        migrations.AddField(
+            model_name='openhumansmember',
+            name='created',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='openhumansmember',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+    ]
@@ -1,18 +1,35 @@
 from datetime import timedelta
 import os
+import threading
+import uuid
 
 import arrow
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
 from django.utils.encoding import python_2_unicode_compatible
 import requests
-import seeq
+
+from . import httpclient, metrics
+from .utils import OH_BASE_URL, get_seeq_client
 
 OH_CLIENT_ID = os.getenv('OH_CLIENT_ID', '')
 OH_CLIENT_SECRET = os.getenv('OH_CLIENT_SECRET', '')
 
-SEEQ_REFRESH_TOKEN = os.getenv('SEEQ_REFRESH_TOKEN')
 SEEQ_STUDY_ID = int(os.getenv('SEEQ_STUDY_ID'))
 
+# Refresh tokens with less than this many seconds left before using them.
+TOKEN_REFRESH_MARGIN = 60
+# The refresh_expiring_tokens task refreshes tokens expiring within this
+# many seconds, so transfers rarely need to refresh them.
+TOKEN_PREREFRESH_WINDOW = int(os.getenv('OH_TOKEN_PREREFRESH_WINDOW', '3600'))
+# Seconds a member's transfer lease lasts without progress. It's renewed as
+# each file is copied, and reclaimed once expired (e.g. after a crash).
+XFER_LEASE_SECONDS = int(os.getenv('XFER_LEASE_SECONDS', '7200'))
+
+# In-process cache of access tokens: oh_id -> (token, usable until).
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+
 
 @python_2_unicode_compatible
 class OpenHumansMember(models.Model):
@@ -23,7 +40,21 @@ class OpenHumansMember(models.Model):
     access_token = models.CharField(max_length=256)
     refresh_token = models.CharField(max_length=256)
     token_expires = models.DateTimeField()
-    seeq_id = models.IntegerField(null=True)
+    seeq_id = models.IntegerField(null=True, db_index=True)
+    # Null for members who joined before this was recorded.
+    created = models.DateTimeField(auto_now_add=True, null=True)
+    # Set while waiting for the member to authorize Seeq.
+    seeq_pending_since = models.DateTimeField(null=True, db_index=True)
+    # Progress of the latest transfer, shown on the completion page.
+    xfer_status = models.CharField(max_length=16, blank=True)
+    xfer_files_total = models.IntegerField(default=0)
+    xfer_files_done = models.IntegerField(default=0)
+    xfer_updated = models.DateTimeField(null=True)
+    # Lease held by the one transfer allowed to run for this member.
+    xfer_lease_owner = models.CharField(max_length=32, blank=True)
+    xfer_lease_expires = models.DateTimeField(null=True)
+    # Set when another transfer was requested while the lease was held.
+    xfer_rerun = models.BooleanField(default=False)
 
     @staticmethod
     def get_expiration(expires_in):
@@ -42,49 +73,247 @@ class OpenHumansMember(models.Model):
         return "<OpenHumansMember(oh_id='{}', seeq_id='{}')>".format(
             self.oh_id, self.seeq_id)
 
+    def save(self, *args, **kwargs):
+        with _token_cache_lock:
+            _token_cache.pop(self.oh_id, None)
+        super(OpenHumansMember, self).save(*args, **kwargs)
+
+    def _cache_access_token(self):
+        """
+        Cache the access token in-process while it's safe to reuse.
+
+        That's until the refresh_expiring_tokens sweep could replace it, as
+        refreshing revokes the old access token.
+        """
+        usable_until = arrow.get(self.token_expires) - timedelta(
+            seconds=TOKEN_PREREFRESH_WINDOW + TOKEN_REFRESH_MARGIN)
+        if usable_until > arrow.now():
+            with _token_cache_lock:
+                _token_cache[self.oh_id] = (self.access_token, usable_until)
+
     def get_access_token(self):
         """
         Return access token. Refresh first if necessary.
         """
-        # Also refresh if nearly expired (less than 60s remaining).
-        delta = timedelta(seconds=60)
+        with _token_cache_lock:
+            cached = _token_cache.get(self.oh_id)
+        # Only trust the cache for the token this instance already holds;
+        # another process may have refreshed it since.
+        if (cached and cached[0] == self.access_token and
+                cached[1] > arrow.now()):
+            return cached[0]
+        # Also refresh if nearly expired.
+        delta = timedelta(seconds=TOKEN_REFRESH_MARGIN)
         if arrow.get(self.token_expires) - delta < arrow.now():
             self._refresh_tokens()
+        self._cache_access_token()
         return self.access_token
 
-    def _refresh_tokens(self):
+    def _refresh_tokens(self, min_valid=TOKEN_REFRESH_MARGIN):
         """
-        Refresh access token.
+        Refresh access token, unless it's valid for min_valid more seconds.
+
+        The member's row is locked during the refresh and re-read first, so
+        when tasks race only one refreshes. The others pick up its tokens
+        instead of trying a refresh token that has already been used.
         """
-        response = requests.post(
-            'https://www.openhumans.org/oauth2/token/',
-            data={
-                'grant_type': 'refresh_token',
-                'refresh_token': self.refresh_token},
-            auth=requests.auth.HTTPBasicAuth(
-                OH_CLIENT_ID, OH_CLIENT_SECRET))
-        if response.status_code == 200:
-            data = response.json()
-            self.access_token = data['access_token']
-            self.refresh_token = data['refresh_token']
-            self.token_expires = self.get_expiration(data['expires_in'])
-            self.save()
+        with transaction.atomic():
+            member = OpenHumansMember.objects.select_for_update().get(
+                oh_id=self.oh_id)
+            delta = timedelta(seconds=min_valid)
+            if arrow.get(member.token_expires) - delta < arrow.now():
+                with metrics.timed('token_refresh'):
+                    response = httpclient.post(
+                        '{}oauth2/token/'.format(OH_BASE_URL),
+                        data={
+                            'grant_type': 'refresh_token',
+                            'refresh_token': member.refresh_token},
+                        auth=requests.auth.HTTPBasicAuth(
+                            OH_CLIENT_ID, OH_CLIENT_SECRET))
+                if response.status_code == 200:
+                    data = response.json()
+                    member.access_token = data['access_token']
+                    member.refresh_token = data['refresh_token']
+                    member.token_expires = self.get_expiration(
+                        data['expires_in'])
+                    member.save()
+                else:
+                    print('Bad response refreshing token for {}: {}'.format(
+                        self.oh_id, response.status_code))
+            self.access_token = member.access_token
+            self.refresh_token = member.refresh_token
+            self.token_expires = member.token_expires
+
+    @classmethod
+    def refresh_expiring_tokens(cls, window=TOKEN_PREREFRESH_WINDOW):
+        """
+        Refresh all tokens that expire within window seconds.
+
+        Tokens already expired are left out. Their refresh has failed
+        before (e.g. the member left the project), so retrying on every
+        sweep would only add OAuth calls. They're still refreshed if a
+        transfer needs them. Returns the number of members checked.
+        """
+        now = arrow.now()
+        soon = (now + timedelta(seconds=window)).datetime
+        members = list(cls.objects.filter(token_expires__gte=now.datetime,
+                                          token_expires__lt=soon))
+        for oh_member in members:
+            oh_member._refresh_tokens(min_valid=window)
+        return len(members)
+
+    def set_xfer_status(self, status, files_total=None, files_done=None):
+        """
+        Store transfer progress: 'waiting', 'running', 'done' or 'failed'.
+
+        '' means a transfer is about to start.
+
+        Saved with an update query, so it never overwrites other fields.
+        """
+        fields = {'xfer_status': status, 'xfer_updated': arrow.now().datetime}
+        if files_total is not None:
+            fields['xfer_files_total'] = files_total
+        if files_done is not None:
+            fields['xfer_files_done'] = files_done
+        OpenHumansMember.objects.filter(oh_id=self.oh_id).update(**fields)
+
+    def count_xfer_file(self):
+        """
+        Add one to the files done in the stored transfer progress.
+
+        Also renews the transfer lease, if this instance holds it.
+        """
+        OpenHumansMember.objects.filter(oh_id=self.oh_id).update(
+            xfer_files_done=F('xfer_files_done') + 1,
+            xfer_updated=arrow.now().datetime)
+        if self.xfer_lease_owner:
+            self.renew_xfer_lease()
+
+    @staticmethod
+    def _lease_expiry():
+        return (arrow.now() + timedelta(seconds=XFER_LEASE_SECONDS)).datetime
+
+    def acquire_xfer_lease(self):
+        """
+        Take the member's transfer lease, so only one transfer runs at once.
+
+        Returns True if acquired. If another transfer holds a live lease,
+        it's asked to run again when done (see release_xfer_lease) and this
+        returns False, merging the request into the running transfer.
+        """
+        owner = uuid.uuid4().hex
+        members = OpenHumansMember.objects.filter(oh_id=self.oh_id)
+        for _ in range(3):
+            now = arrow.now().datetime
+            if members.filter(
+                    Q(xfer_lease_expires__isnull=True) |
+                    Q(xfer_lease_expires__lt=now)).update(
+                        xfer_lease_owner=owner,
+                        xfer_lease_expires=self._lease_expiry(),
+                        xfer_rerun=False):
+                self.xfer_lease_owner = owner
+                return True
+            # If the lease was released meanwhile, try to take it again.
+            if members.filter(xfer_lease_expires__gte=now).update(
+                    xfer_rerun=True):
+                return False
+        # Still racing other transfers, so leave the request to them.
+        members.update(xfer_rerun=True)
+        return False
+
+    def renew_xfer_lease(self):
+        OpenHumansMember.objects.filter(
+            oh_id=self.oh_id, xfer_lease_owner=self.xfer_lease_owner).update(
+                xfer_lease_expires=self._lease_expiry())
+
+    def release_xfer_lease(self):
+        """
+        Give up the transfer lease. Returns True if a rerun was requested.
+        """
+        owner, self.xfer_lease_owner = self.xfer_lease_owner, ''
+        with transaction.atomic():
+            member = OpenHumansMember.objects.select_for_update().get(
+                oh_id=self.oh_id)
+            if member.xfer_lease_owner != owner:
+                print('Transfer lease for {} expired and was taken by '
+                      'another transfer.'.format(self.oh_id))
+                return False
+            OpenHumansMember.objects.filter(oh_id=self.oh_id).update(
+                xfer_lease_owner='', xfer_lease_expires=None,
+                xfer_rerun=False)
+        return member.xfer_rerun
 
     @classmethod
     def update_seeq_ids(cls):
         """
         Run to update all users in our database with Seeq IDs where available.
+
+        Members are loaded in one query and new Seeq IDs are saved with one
+        bulk update. Returns counts of 'matched', 'updated' and 'unknown'
+        Seeq participants.
         """
-        c = seeq.client.Client(None)
-        c.set_refresh_token(SEEQ_REFRESH_TOKEN)
+        with metrics.timed('update_seeq_ids'):
+            return cls._update_seeq_ids()
+
+    @classmethod
+    def _update_seeq_ids(cls):
+        c = get_seeq_client()
         participants = c.study_participants_get(SEEQ_STUDY_ID)
-        for user in participants:
-            try:
-                oh_member = cls.objects.get(oh_id=user['external_id'])
-            except cls.DoesNotExist:
-                print('Seeq reports external_id "{}" with no '
-                      'match in db!'.format(user['external_id']))
-                continue
-            if not oh_member.seeq_id:
-                oh_member.seeq_id = user['id']
-                oh_member.save()
+        seeq_ids = {user['external_id']: user['id'] for user in participants}
+        with transaction.atomic():
+            members = dict(cls.objects.select_for_update().filter(
+                oh_id__in=list(seeq_ids)).values_list('oh_id', 'seeq_id'))
+            for external_id in seeq_ids:
+                if external_id not in members:
+                    print('Seeq reports external_id "{}" with no '
+                          'match in db!'.format(external_id))
+            to_update = {oh_id: seeq_ids[oh_id] for oh_id, seeq_id
+                         in members.items() if not seeq_id}
+            if to_update:
+                cls.objects.filter(oh_id__in=list(to_update)).update(
+                    seeq_id=Case(
+                        *[When(oh_id=oh_id, then=Value(seeq_id))
+                          for oh_id, seeq_id in to_update.items()],
+                        output_field=IntegerField()))
+        return {'matched': len(members),
+                'updated': len(to_update),
+                'unknown': len(seeq_ids) - len(members)}
+
+
+@python_2_unicode_compatible
+class SeeqFileTransfer(models.Model):
+    """
+    Ledger entry for a Seeq file known to be in Open Humans.
+
+    Lets dataxfer skip files it has already copied without fetching the
+    member's Open Humans file list.
+    """
+    member = models.ForeignKey(OpenHumansMember, on_delete=models.CASCADE,
+                               related_name='seeq_files')
+    seeq_filename = models.CharField(max_length=255)
+    size = models.BigIntegerField(null=True)
+    etag = models.CharField(max_length=64, blank=True)
+    md5 = models.CharField(max_length=32, blank=True)
+    oh_file_id = models.IntegerField(null=True)
+    transferred = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('member', 'seeq_filename'),)
+
+    def __str__(self):
+        return "<SeeqFileTransfer(member='{}', seeq_filename='{}')>".format(
+            self.member_id, self.seeq_filename)
+
+    @classmethod
+    def record(cls, oh_member, result):
+        """
+        Record a file result from dataxfer.xfer_result in the ledger.
+        """
+        transfer, _ = cls.objects.update_or_create(
+            member=oh_member,
+            seeq_filename=result['filename'],
+            defaults={'size': result['bytes'] or None,
+                      'etag': result['etag'],
+                      'md5': result['md5'],
+                      'oh_file_id': result['file_id']})
+        return transfer
@@ -0,0 +1,171 @@
+"""
+Rate limits for Open Humans API calls and S3 transfer bandwidth.
+
+Limits are token buckets shared by every thread in a process. Each family
+of Open Humans API endpoints has its own AdaptiveLimiter. It slows down when
+Open Humans answers 429, honouring Retry-After, then speeds back up to its
+ceiling as calls succeed. Downloads and uploads each have a byte-rate
+TokenBucket, applied to the streams with throttled().
+
+A rate of 0 means no limit. API limiters with no ceiling still pause for
+Retry-After.
+"""
+from __future__ import print_function
+
+from email.utils import mktime_tz, parsedate_tz
+import os
+import threading
+import time
+
+from requests.utils import super_len
+
+from . import metrics
+
+# Most calls per second to each family of Open Humans API endpoints.
+OH_UPLOAD_API_RATE = float(os.getenv('OH_UPLOAD_API_RATE', '0'))
+OH_EXCHANGE_API_RATE = float(os.getenv('OH_EXCHANGE_API_RATE', '0'))
+# Most bytes per second of S3 downloads and uploads, per process.
+DOWNLOAD_BYTES_PER_SEC = int(os.getenv('DOWNLOAD_BYTES_PER_SEC', '0'))
+UPLOAD_BYTES_PER_SEC = int(os.getenv('UPLOAD_BYTES_PER_SEC', '0'))
+
+# Seconds to pause after a 429 that doesn't say how long to wait.
+DEFAULT_RETRY_AFTER = 1.0
+# After a 429 the rate is halved, but never below this part of the ceiling.
+MIN_RATE_FRACTION = 0.1
+# Each successful call raises the rate by this part of the ceiling.
+RATE_INCREASE = 0.05
+
+
+class TokenBucket(object):
+    """
+    Allow rate units per second on average, in bursts of up to burst units.
+
+    acquire() takes its units at once, going into debt if the bucket runs
+    short, and sleeps until the debt is paid. So callers are served in
+    turn, and amounts bigger than the burst are allowed.
+    """
+    def __init__(self, name, rate, burst=None):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _take(self, amount):
+        """
+        Take amount tokens, returning the seconds to wait for them.
+        """
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens +
+                           (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+    def _wait(self, seconds):
+        if seconds > 0:
+            with metrics.timed('{}_wait'.format(self.name)):
+                time.sleep(seconds)
+
+    def acquire(self, amount=1):
+        if not self.rate:
+            return
+        with self._lock:
+            delay = self._take(amount)
+        self._wait(delay)
+
+
+class AdaptiveLimiter(TokenBucket):
+    """
+    Token bucket for API calls that backs off when the server throttles.
+
+    The rate starts at ceiling. Each throttled() call pauses all callers
+    for Retry-After seconds and halves the rate (at most once a second, as
+    a burst of calls is often throttled together). Each succeeded() call
+    adds RATE_INCREASE of the ceiling back.
+    """
+    def __init__(self, name, ceiling):
+        super(AdaptiveLimiter, self).__init__(name, ceiling,
+                                              burst=max(1.0, ceiling))
+        self.ceiling = float(ceiling)
+        self._paused_until = 0.0
+        self._last_cut = 0.0
+
+    def acquire(self, amount=1):
+        with self._lock:
+            pause = self._paused_until - time.time()
+        self._wait(pause)
+        super(AdaptiveLimiter, self).acquire(amount)
+
+    def throttled(self, retry_after=None):
+        now = time.time()
+        with self._lock:
+            self._paused_until = max(
+                self._paused_until, now + (retry_after or DEFAULT_RETRY_AFTER))
+            if self.ceiling and now - self._last_cut >= 1:
+                self.rate = max(self.ceiling * MIN_RATE_FRACTION,
+                                self.rate / 2)
+                self._last_cut = now
+                print('Rate limit for {} lowered to {:.2f}/s.'.format(
+                    self.name, self.rate))
+
+    def succeeded(self):
+        if self.rate < self.ceiling:
+            with self._lock:
+                self.rate = min(self.ceiling,
+                                self.rate + self.ceiling * RATE_INCREASE)
+
+
+api_limiters = {
+    'oh_upload': AdaptiveLimiter('oh_upload', OH_UPLOAD_API_RATE),
+    'oh_exchange': AdaptiveLimiter('oh_exchange', OH_EXCHANGE_API_RATE),
+}
+download_bandwidth = TokenBucket('s3_download', DOWNLOAD_BYTES_PER_SEC)
+upload_bandwidth = TokenBucket('s3_upload', UPLOAD_BYTES_PER_SEC)
+
+
+def parse_retry_after(value):
+    """
+    Return the seconds to wait given a Retry-After header, or None.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed:
+            return max(0.0, mktime_tz(parsed) - time.time())
+    return None
+
+
+class ThrottledReader(object):
+    """
+    File-like wrapper that reads data no faster than a TokenBucket allows.
+
+    Its length is that of the unread data, so requests can still send it
+    with a Content-Length header.
+    """
+    def __init__(self, data, bucket):
+        self._data = data
+        self._bucket = bucket
+
+    def __len__(self):
+        return super_len(self._data)
+
+    def read(self, amt=-1):
+        chunk = self._data.read(amt)
+        self._bucket.acquire(len(chunk))
+        return chunk
+
+
+def throttled(data, bucket):
+    """
+    Return data limited by bucket, or data itself if the bucket has no limit.
+    """
+    if not bucket.rate:
+        return data
+    return ThrottledReader(data, bucket)
@@ -1 +1,68 @@
-// Placeholder file for local JavaScript.
+// Local JavaScript.
+
+// Poll transfer status on the completion page.
+$(function () {
+  var $status = $('#transfer-status');
+  if (!$status.length) {
+    return;
+  }
+  // Milliseconds between polls while a transfer waits on the member or runs.
+  var WAITING_INTERVAL = 30000;
+  var RUNNING_INTERVAL = 3000;
+  var messages = {
+    '': 'Starting your transfer.',
+    waiting: 'Waiting for your Seeq authorization.',
+    running: 'Transferring your data',
+    done: 'Transfer complete',
+    failed: 'Some files could not be transferred yet. We will try again.'
+  };
+
+  // Show the status and return milliseconds until the next poll, or 0 to
+  // stop polling.
+  function update(data) {
+    if (data.authorization === 'pending') {
+      return RUNNING_INTERVAL;
+    }
+    $('#auth-pending').hide();
+    if (data.authorization === 'failed') {
+      $('#auth-failed').show();
+      return 0;
+    }
+    $('#oh-id').text(data.oh_id);
+    $('#seeq-url').attr('href', data.seeq_url);
+    $('#auth-complete').show();
+    var transfer = data.transfer;
+    var message = messages[transfer.status] || '';
+    if (transfer.status === 'running' || transfer.status === 'done') {
+      message += ': ' + transfer.files_done + ' of ' + transfer.files_total +
+        ' files.';
+    }
+    $('#transfer-progress').text(message);
+    var $files = $('#transfer-files').empty();
+    $.each(transfer.files, function (i, filename) {
+      $('<li>').text(filename).appendTo($files);
+    });
+    // Seeq authorization can take the member a while, so poll slowly for
+    // it. A failed transfer is retried later, not while the page is open.
+    if (transfer.status === 'waiting') {
+      return WAITING_INTERVAL;
+    }
+    if (transfer.status === 'done' || transfer.status === 'failed') {
+      return 0;
+    }
+    return RUNNING_INTERVAL;
+  }
+
+  function poll() {
+    $.getJSON($status.data('status-url')).done(function (data) {
+      var interval = update(data);
+      if (interval) {
+        setTimeout(poll, interval);
+      }
+    }).fail(function () {
+      setTimeout(poll, 10000);
+    });
+  }
+
+  poll();
+});
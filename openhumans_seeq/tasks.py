@@ -1,42 +1,179 @@
 from __future__ import absolute_import, print_function
 
+from datetime import timedelta
+import os
 import shutil
 import tempfile
 
+import arrow
 from celery import shared_task
+from celery.signals import (task_postrun, task_prerun,
+                            worker_process_shutdown)
+from django.core.cache import cache
 
-from .dataxfer import dataxfer
+from . import metrics
+from .dataxfer import dataxfer, summarize_results
 from .models import OpenHumansMember
 
+# Seconds to wait for a new member to authorize Seeq before giving up.
+SEEQ_PENDING_EXPIRY = int(os.getenv('SEEQ_PENDING_EXPIRY', '3600'))
+# Seconds to remember the outcome of an Open Humans authorization.
+OH_AUTH_RESULT_TTL = 24 * 60 * 60
 
-@shared_task
-def init_xfer_to_open_humans(oh_id, num_submit=0, logger=None, **kwargs):
+
+def oh_auth_cache_key(auth_key):
+    return 'oh_auth:{}'.format(auth_key)
+
+
+@task_prerun.connect
+def start_task_metrics(task=None, **kwargs):
+    metrics.start_task()
+
+
+@task_postrun.connect
+def finish_task_metrics(task=None, **kwargs):
+    metrics.finish_task(task.name)
+
+
+@worker_process_shutdown.connect
+def unpublish_metrics(**kwargs):
+    metrics.unpublish()
+
+
+def dataxfer_with_tempdir(oh_member, seeq_data=None):
+    """
+    Run dataxfer for a member using a tempdir that's removed afterwards.
+    """
+    tempdir = tempfile.mkdtemp()
+    try:
+        results = dataxfer(oh_member=oh_member, tempdir=tempdir,
+                           seeq_data=seeq_data)
+    except Exception as inst:
+        shutil.rmtree(tempdir)
+        raise inst
+    shutil.rmtree(tempdir)
+    return results
+
+
+@shared_task(ignore_result=True)
+def complete_oh_authorization(code, auth_key):
+    """
+    Finish an Open Humans authorization started by the complete view.
+
+    Exchanges the code, saves the member, resets their transfer progress
+    and starts their transfer. The
+    member ID (or '' if the exchange failed) is cached under auth_key for
+    the status view.
+    """
+    from .views import oh_code_to_member
+    oh_member = oh_code_to_member(code=code)
+    if not oh_member:
+        print('Invalid code exchange.')
+        cache.set(oh_auth_cache_key(auth_key), '', OH_AUTH_RESULT_TTL)
+        return
+    # Clear the last transfer's progress, so a returning member's page
+    # doesn't show it as this one's.
+    oh_member.set_xfer_status('', files_total=0, files_done=0)
+    cache.set(oh_auth_cache_key(auth_key), oh_member.oh_id,
+              OH_AUTH_RESULT_TTL)
+    init_xfer_to_open_humans.delay(oh_id=oh_member.oh_id)
+
+
+# kwargs only accepts num_submit and logger from tasks queued before
+# rescheduling was replaced by sweep_pending_members.
+@shared_task(ignore_result=True)
+def init_xfer_to_open_humans(oh_id, **kwargs):
     """
     Initial transfer of data to Open Humans.
 
-    Because Seeq authorization may take time (for example, the user may need
-    to create an account), retry this task a couple times. Each attempt,
-    call Seeq to refresh Seeq IDs -- a Seeq ID (1) indicates Seeq authorization
-    is complete, and (2) is needed for data retrieval.
+    A Seeq ID (1) indicates Seeq authorization is complete, and (2) is needed
+    for data retrieval. Because Seeq authorization may take time (for example,
+    the user may need to create an account), a member without one is marked
+    as pending. sweep_pending_members then links them and starts this
+    transfer once Seeq reports them.
     """
     print('Trying to copy data for {} to Open Humans'.format(oh_id))
-    OpenHumansMember.update_seeq_ids()
     oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
     if not oh_member.seeq_id:
-        if num_submit < 9:
-            num_submit += 1
-            init_xfer_to_open_humans.apply_async(
-                args=[oh_id, num_submit], kwargs=kwargs,
-                countdown=(2 * 2**num_submit))
-            print('Resubmitting, num_submit is {}.'.format(num_submit))
-            return 'resubmitted'
-        else:
-            print('Giving up on init xfer for {}.'.format(oh_id))
-    else:
-        tempdir = tempfile.mkdtemp()
-        try:
-            dataxfer(oh_member=oh_member, tempdir=tempdir)
-        except Exception as inst:
-            shutil.rmtree(tempdir)
-            raise inst
-        shutil.rmtree(tempdir)
+        oh_member.seeq_pending_since = arrow.now().datetime
+        oh_member.save(update_fields=['seeq_pending_since'])
+        oh_member.set_xfer_status('waiting')
+        print('Member {} is waiting for Seeq authorization.'.format(oh_id))
+        return 'pending'
+    dataxfer_with_tempdir(oh_member)
+
+
+@shared_task(ignore_result=True)
+def sweep_pending_members():
+    """
+    Link members waiting for Seeq authorization and start their transfers.
+
+    Seeq's participant list is fetched once per run, however many members are
+    waiting. Members still unlinked after SEEQ_PENDING_EXPIRY seconds are
+    given up on.
+    """
+    expiry = (arrow.now() - timedelta(seconds=SEEQ_PENDING_EXPIRY)).datetime
+    expired = OpenHumansMember.objects.filter(seeq_pending_since__lt=expiry)
+    for oh_id in expired.values_list('oh_id', flat=True):
+        print('Giving up on init xfer for {}.'.format(oh_id))
+    expired.update(seeq_pending_since=None)
+    pending = list(OpenHumansMember.objects.filter(
+        seeq_pending_since__isnull=False).values_list('oh_id', flat=True))
+    if not pending:
+        return
+    counts = OpenHumansMember.update_seeq_ids()
+    print('Seeq IDs: {matched} matched, {updated} updated, '
+          '{unknown} unknown.'.format(**counts))
+    linked = list(OpenHumansMember.objects.filter(
+        oh_id__in=pending, seeq_id__isnull=False).values_list(
+            'oh_id', flat=True))
+    OpenHumansMember.objects.filter(oh_id__in=linked).update(
+        seeq_pending_since=None)
+    for oh_id in linked:
+        init_xfer_to_open_humans.delay(oh_id=oh_id)
+    print('{} of {} pending members linked to Seeq.'.format(
+        len(linked), len(pending)))
+
+
+@shared_task(ignore_result=True)
+def refresh_expiring_tokens():
+    """
+    Refresh Open Humans tokens that will expire soon, in one periodic sweep.
+
+    Keeps OAuth refreshes off the transfer path.
+    """
+    count = OpenHumansMember.refresh_expiring_tokens()
+    print('Checked {} expiring Open Humans tokens.'.format(count))
+
+
+@shared_task(ignore_result=True)
+def transfer_member(oh_id):
+    """
+    Copy new Seeq data for a member, without keeping a result.
+
+    For transfers nothing waits on, e.g. ones merged into a transfer that
+    then failed.
+    """
+    print('Syncing member {}...'.format(oh_id))
+    oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
+    if not oh_member.seeq_id:
+        print('Member {} has no corresponding Seeq ID.'.format(oh_id))
+        return
+    dataxfer_with_tempdir(oh_member)
+
+
+@shared_task
+def xfer_to_open_humans(oh_id, seeq_data=None):
+    """
+    Copy new Seeq data for a member already linked to a Seeq ID.
+
+    Used by sync_all to spread a full sync across workers, passing along
+    listings it fetched in batches as seeq_data. Returns a summary of the
+    transfer (see dataxfer.summarize_results).
+    """
+    print('Syncing member {}...'.format(oh_id))
+    oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
+    if not oh_member.seeq_id:
+        print('Member {} has no corresponding Seeq ID.'.format(oh_id))
+        return summarize_results([])
+    return summarize_results(dataxfer_with_tempdir(oh_member, seeq_data))
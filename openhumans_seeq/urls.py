@@ -22,4 +22,7 @@ urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^$', views.index),
     url(r'complete/?$', views.complete),
+    url(r'^status/?$', views.status),
+    url(r'^seeq/notify/?$', views.seeq_notify),
+    url(r'^metrics/?$', views.metrics_view),
 ]
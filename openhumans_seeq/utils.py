@@ -1,16 +1,156 @@
-import requests
+import os
+import threading
+import time
 
-OH_BASE_URL = 'https://www.openhumans.org/'
+from django.core.cache import cache
+import seeq
 
+from . import httpclient, metrics
 
-def oh_get_member_data(token):
+OH_BASE_URL = os.getenv('OH_BASE_URL', 'https://www.openhumans.org/')
+# Seconds to reuse a member's Open Humans data, 0 to always fetch it.
+OH_MEMBER_DATA_TTL = int(os.getenv('OH_MEMBER_DATA_TTL', '300'))
+# Members with more files than this aren't cached, bounding entry size.
+OH_MEMBER_DATA_MAX_FILES = int(os.getenv('OH_MEMBER_DATA_MAX_FILES', '2000'))
+# Seconds to keep expired data that can be revalidated with a conditional
+# request, if Open Humans sent an ETag or Last-Modified header.
+OH_MEMBER_DATA_STALE = 24 * 60 * 60
+
+SEEQ_REFRESH_TOKEN = os.getenv('SEEQ_REFRESH_TOKEN')
+# Seconds to reuse a Seeq access token before authenticating again.
+SEEQ_TOKEN_TTL = int(os.getenv('SEEQ_TOKEN_TTL', '3000'))
+
+_seeq_client = None
+_seeq_client_lock = threading.Lock()
+
+
+def _member_data_key(oh_id):
+    return 'oh_member_data:{}'.format(oh_id)
+
+
+def _cache_member_data(entry):
+    """
+    Save member data fetched from Open Humans in the shared Django cache.
+    """
+    if (not OH_MEMBER_DATA_TTL or
+            len(entry['member_data']['data']) > OH_MEMBER_DATA_MAX_FILES):
+        return
+    timeout = OH_MEMBER_DATA_TTL
+    if entry['etag'] or entry['last_modified']:
+        timeout += OH_MEMBER_DATA_STALE
+    cache.set(_member_data_key(entry['member_data']['project_member_id']),
+              entry, timeout)
+
+
+def invalidate_member_data(oh_id):
+    """
+    Drop cached member data, e.g. after uploading a file for the member.
+    """
+    cache.delete(_member_data_key(oh_id))
+
+
+def oh_get_member_data(token, oh_id=None):
     """
     Exchange OAuth2 token for member data.
+
+    Returns the member's 'project_member_id' and their files as 'data',
+    each with its 'id' and 'basename'. Results are cached for
+    OH_MEMBER_DATA_TTL seconds. If oh_id is given, a cached copy is
+    returned while fresh, and revalidated with a conditional request once
+    expired if Open Humans sent an ETag or Last-Modified header.
+    """
+    cached = None
+    if oh_id and OH_MEMBER_DATA_TTL:
+        cached = cache.get(_member_data_key(oh_id))
+    if cached and cached['fetched'] + OH_MEMBER_DATA_TTL > time.time():
+        return cached['member_data']
+    headers = {}
+    if cached and cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached['last_modified']:
+        headers['If-Modified-Since'] = cached['last_modified']
+    with metrics.timed('oh_member_data'):
+        req = httpclient.api_request(
+            'oh_exchange', 'GET',
+            '{}api/direct-sharing/project/exchange-member/'.format(
+                OH_BASE_URL),
+            params={'access_token': token}, headers=headers)
+    if req.status_code == 304 and cached:
+        cached['fetched'] = time.time()
+        _cache_member_data(cached)
+        return cached['member_data']
+    if req.status_code != 200:
+        raise Exception('Status code {}'.format(req.status_code))
+    data = req.json()
+    entry = {
+        'member_data': {
+            'project_member_id': data['project_member_id'],
+            'data': [{'id': f.get('id'), 'basename': f['basename']}
+                     for f in data['data']],
+        },
+        'fetched': time.time(),
+        'etag': req.headers.get('ETag'),
+        'last_modified': req.headers.get('Last-Modified'),
+    }
+    _cache_member_data(entry)
+    return entry['member_data']
+
+
+class SeeqClient(object):
+    """
+    Seeq API client shared by everything in a process.
+
+    Authenticates once and reuses the access token for SEEQ_TOKEN_TTL
+    seconds. The first call after that re-authenticates under a lock, so
+    concurrent callers don't each do their own exchange.
+    """
+    def __init__(self):
+        self._client = None
+        self._expires = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if (self._client is None or self._pid != os.getpid() or
+                self._expires < time.time()):
+            with self._lock:
+                if (self._client is None or self._pid != os.getpid() or
+                        self._expires < time.time()):
+                    client = seeq.client.Client(None)
+                    client.set_refresh_token(SEEQ_REFRESH_TOKEN)
+                    self._expires = time.time() + SEEQ_TOKEN_TTL
+                    self._pid = os.getpid()
+                    self._client = client
+        return self._client
+
+    def _call(self, name, *args):
+        client = self._get_client()
+        with metrics.timed('seeq_{}'.format(name)):
+            return getattr(client, name)(*args)
+
+    def study_participants_get(self, study_id):
+        return self._call('study_participants_get', study_id)
+
+    def study_raw_data_get(self, study_id, participant_ids):
+        return self._call('study_raw_data_get', study_id, participant_ids)
+
+
+def set_seeq_client(client):
+    """
+    Replace the shared Seeq client, e.g. with a local stand-in for benchmarks.
+    """
+    global _seeq_client
+    with _seeq_client_lock:
+        _seeq_client = client
+
+
+def get_seeq_client():
+    """
+    Return this process's shared SeeqClient.
     """
-    req = requests.get(
-        '{}api/direct-sharing/project/exchange-member/'.format(OH_BASE_URL),
-        params={'access_token': token})
-    if req.status_code == 200:
-        return req.json()
-    raise Exception('Status code {}'.format(req.status_code))
-    return None
+    global _seeq_client
+    if _seeq_client is None:
+        with _seeq_client_lock:
+            if _seeq_client is None:
+                _seeq_client = SeeqClient()
+    return _seeq_client
@@ -1,21 +1,35 @@
+import hmac
+import json
 import os
+import uuid
 
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 import requests
 import seeq
 
-from .models import OpenHumansMember
-from .tasks import init_xfer_to_open_humans
-from .utils import oh_get_member_data
+from . import httpclient, metrics
+from .models import OpenHumansMember, SeeqFileTransfer
+from .tasks import (complete_oh_authorization, oh_auth_cache_key,
+                    transfer_member)
+from .utils import OH_BASE_URL, oh_get_member_data
 
 # Open Humans settings
 OH_CLIENT_ID = os.getenv('OH_CLIENT_ID')
 OH_CLIENT_SECRET = os.getenv('OH_CLIENT_SECRET')
-OH_BASE_URL = 'https://www.openhumans.org/'
 
 # SEEQ settings
 SEEQ_API_KEY_PRODUCTION = os.getenv('SEEQ_API_KEY_PRODUCTION')
 SEEQ_STUDY_ID = int(os.getenv('SEEQ_STUDY_ID'))
+# Shared secret Seeq sends in the X-Seeq-Notify-Secret header of new data
+# notifications. The endpoint is disabled if unset.
+SEEQ_NOTIFY_SECRET = os.getenv('SEEQ_NOTIFY_SECRET', '')
+# Seconds to wait after a notification before transferring. Notifications
+# for the same participant meanwhile are folded into that transfer.
+SEEQ_NOTIFY_DEBOUNCE = int(os.getenv('SEEQ_NOTIFY_DEBOUNCE', '10'))
 
 # Project details
 OHSEEQ_BASE_URL = os.getenv('OHSEEQ_BASE_URL', 'http://127.0.0.1:5000/')
@@ -34,7 +48,7 @@ def oh_code_to_member(code):
             'redirect_uri': '{}complete'.format(OHSEEQ_BASE_URL),
             'code': code,
         }
-        req = requests.post(
+        req = httpclient.post(
             '{}oauth2/token/'.format(OH_BASE_URL),
             data=data,
             auth=requests.auth.HTTPBasicAuth(
@@ -52,6 +66,10 @@ def oh_code_to_member(code):
                 oh_member.refresh_token = data['refresh_token']
                 oh_member.token_expires = OpenHumansMember.get_expiration(
                     data['expires_in'])
+                # Only save tokens, leaving transfer state to the tasks.
+                oh_member.save(update_fields=[
+                    'access_token', 'refresh_token', 'token_expires'])
+                return oh_member
             except OpenHumansMember.DoesNotExist:
                 oh_member = OpenHumansMember.create(
                     oh_id=oh_id,
@@ -80,19 +98,102 @@ def index(request):
 
 def complete(request):
     """
-    Receive user from Open Humans. Store data, start task, prompt Seeq auth.
+    Receive user from Open Humans. Start tasks, let the page poll for status.
+
+    The code exchange, member lookup and transfer all happen in the
+    background (see tasks.complete_oh_authorization), so this responds
+    without waiting on Open Humans.
     """
     print("Received user returning from Open Humans.")
     code = request.GET.get('code', '')
-    oh_member = oh_code_to_member(code=code)
-    if oh_member:
-        init_xfer_to_open_humans.delay(oh_id=oh_member.oh_id)
-        seeq_url = seeq.util.jwt_signed(
-            SEEQ_STUDY_ID,
-            oh_member.oh_id,
-            SEEQ_API_KEY_PRODUCTION)
-        context = {'oh_id': oh_member.oh_id, 'seeq_url': seeq_url}
-        return render(request, 'openhumans_seeq/complete.html',
-                      context=context)
-    print('Invalid code exchange. User returned to starting page.')
-    return redirect('/')
+    if not code:
+        print('No code received. User returned to starting page.')
+        return redirect('/')
+    auth_key = uuid.uuid4().hex
+    request.session['oh_auth_key'] = auth_key
+    complete_oh_authorization.delay(code=code, auth_key=auth_key)
+    return render(request, 'openhumans_seeq/complete.html')
+
+
+def status(request):
+    """
+    Report authorization and transfer progress for the completion page.
+    """
+    auth_key = request.session.get('oh_auth_key')
+    if not auth_key:
+        return JsonResponse({'authorization': 'failed'})
+    oh_id = cache.get(oh_auth_cache_key(auth_key))
+    if oh_id is None:
+        return JsonResponse({'authorization': 'pending'})
+    if not oh_id:
+        return JsonResponse({'authorization': 'failed'})
+    try:
+        oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
+    except OpenHumansMember.DoesNotExist:
+        return JsonResponse({'authorization': 'failed'})
+    seeq_url = seeq.util.jwt_signed(
+        SEEQ_STUDY_ID,
+        oh_member.oh_id,
+        SEEQ_API_KEY_PRODUCTION)
+    files = SeeqFileTransfer.objects.filter(member=oh_member).order_by(
+        'transferred').values_list('seeq_filename', flat=True)
+    return JsonResponse({
+        'authorization': 'complete',
+        'oh_id': oh_member.oh_id,
+        'seeq_url': seeq_url,
+        'transfer': {
+            'status': oh_member.xfer_status,
+            'files_total': oh_member.xfer_files_total,
+            'files_done': oh_member.xfer_files_done,
+            'files': list(files),
+        },
+    })
+
+
+def metrics_view(request):
+    """
+    Report transfer phase counters in Prometheus text format.
+    """
+    if not metrics.METRICS_ENABLED:
+        raise Http404
+    return HttpResponse(metrics.render_prometheus(),
+                        content_type='text/plain; version=0.0.4')
+
+
+@csrf_exempt
+@require_POST
+def seeq_notify(request):
+    """
+    Receive notice of new Seeq raw data and queue a transfer for its member.
+
+    Takes a 'participant_id' (the Seeq ID) as JSON or form data. The
+    transfer starts SEEQ_NOTIFY_DEBOUNCE seconds later, so a burst of
+    notifications for one participant results in one transfer.
+    """
+    if not SEEQ_NOTIFY_SECRET:
+        raise Http404
+    secret = request.META.get('HTTP_X_SEEQ_NOTIFY_SECRET', '')
+    if not hmac.compare_digest(secret.encode('utf-8'),
+                               SEEQ_NOTIFY_SECRET.encode('utf-8')):
+        return JsonResponse({'error': 'Bad secret.'}, status=403)
+    try:
+        if request.content_type == 'application/json':
+            data = json.loads(request.body.decode('utf-8'))
+        else:
+            data = request.POST
+        seeq_id = int(data['participant_id'])
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({'error': 'Expected a participant_id.'},
+                            status=400)
+    oh_id = OpenHumansMember.objects.filter(seeq_id=seeq_id).values_list(
+        'oh_id', flat=True).first()
+    if not oh_id:
+        print('Notified of data for unknown Seeq ID {}.'.format(seeq_id))
+        return JsonResponse({'status': 'unknown'}, status=404)
+    if not cache.add('seeq_notify:{}'.format(seeq_id), oh_id,
+                     SEEQ_NOTIFY_DEBOUNCE):
+        return JsonResponse({'status': 'merged'}, status=202)
+    print('Queueing transfer for {} on Seeq notification.'.format(oh_id))
+    transfer_member.apply_async(args=[oh_id],
+                                countdown=SEEQ_NOTIFY_DEBOUNCE)
+    return JsonResponse({'status': 'queued'}, status=202)